@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+cost of augment.BatchAugment per batch, against the same ops done per sample in numpy.
+
+usage:
+    python bench_augment.py --batch_sizes=8,32,128 --augment=speed,shift,gain,mix,mixup
+
+'per sample' resamples (np.interp), scales and mixes one window at a time, as
+an augmentation in Dataset.__getitem__ would. Both are timed on the cpu; with
+main.py --cuda the batch ops run on the gpu.
+
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from augment import *
+from util import window_length
+
+
+def per_sample(waves, rng, ops, max_rate=0.1, max_shift=0.1, max_gain_db=6., mix_prob=0.5):
+    out = []
+    length = waves.shape[1]
+    c = (length - 1) / 2.
+    t = np.arange(length)
+    for i, wave in enumerate(waves):
+        rate = rng.uniform(1 - max_rate, 1 + max_rate) if 'speed' in ops else 1.
+        shift = rng.uniform(-max_shift, max_shift) * length if 'shift' in ops else 0.
+        if 'speed' in ops or 'shift' in ops:
+            wave = np.interp(c + (t - c) * rate - shift, t, wave, left=0., right=0.)
+        if 'gain' in ops:
+            wave = wave * 10 ** (rng.uniform(-max_gain_db, max_gain_db) / 20)
+        if 'mix' in ops and rng.uniform() < mix_prob:
+            other = waves[rng.randint(len(waves))]
+            wave = wave + other * np.sqrt(np.mean(wave ** 2) / max(np.mean(other ** 2), 1e-16)) * \
+                10 ** (-rng.uniform(5, 20) / 20)
+        if 'mixup' in ops:
+            lam = rng.beta(0.2, 0.2)
+            wave = lam * wave + (1 - lam) * waves[rng.randint(len(waves))]
+        out.append(wave.astype(np.float32))
+    return np.stack(out)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='batch against per-sample augmentation')
+    parser.add_argument('--batch_sizes', type=str, default='8,32,128')
+    parser.add_argument('--augment', type=str, default=','.join(AUGMENTATIONS))
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    ops = args.augment.split(',')
+    augment = BatchAugment(ops, seed=0)
+    rng = np.random.RandomState(0)
+
+    print('{:>6s} {:>12s} {:>12s} {:>14s} {:>8s}'.format('batch', 'batch(ms)', 'per sample', 'ms/sample', 'speedup'))
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        data = 0.1 * torch.randn(batch_size, 1, window_length(args.fs))
+        label = torch.zeros(batch_size, dtype=torch.long)
+        waves = data[:, 0].numpy()
+
+        augment(data, label)  # warm up
+        start = time.time()
+        for _ in range(args.repeats):
+            augment(data, label)
+        batch = 1000 * (time.time() - start) / args.repeats
+
+        start = time.time()
+        for _ in range(args.repeats):
+            per_sample(waves, rng, ops)
+        sample = 1000 * (time.time() - start) / args.repeats
+
+        print('{:6d} {:10.1f}ms {:10.1f}ms {:8.2f}/{:.2f}ms {:7.1f}x'.format(
+            batch_size, batch, sample, batch / batch_size, sample / batch_size, sample / batch))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+peak memory and time of a training step against batch size, with and without
+checkpointing of the waveform frontend (main.py --checkpoint_frontend).
+
+usage:
+    python bench_checkpoint.py --network=WaveMsNet --batch_sizes=8,16,32,64
+
+each configuration runs in its own process; peak is the growth of its max RSS
+during the steps, i.e. activations, gradients and optimizer state.
+
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import network
+
+
+def rss():
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2.**20
+
+
+def run_step(queue, network_name, batch_size, checkpoint_frontend, steps, num_threads, fs):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = getattr(network, network_name)(fs=fs)
+    model.checkpoint_frontend = checkpoint_frontend
+    model.train()
+    optimizer = optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    data = torch.randn(batch_size, 1, model.win_size)
+    label = torch.zeros(batch_size, dtype=torch.long)
+
+    before = rss()
+    start = time.time()
+    for _ in range(steps):
+        optimizer.zero_grad()
+        loss = F.cross_entropy(model(data), label)
+        loss.backward()
+        optimizer.step()
+    elapse = (time.time() - start) / steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. - before  # ru_maxrss is in kB
+    queue.put((peak, elapse))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='training step memory with frontend checkpointing')
+    parser.add_argument('--network', type=str, default='WaveMsNet')
+    parser.add_argument('--batch_sizes', type=str, default='8,16,32')
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--fs', type=int, default=44100)
+    args = parser.parse_args()
+
+    print('{:>6s} {:>14s} {:>14s} {:>10s} {:>10s}'.format(
+        'batch', 'default(MB)', 'checkpoint(MB)', 'default', 'checkpoint'))
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        results = []
+        for checkpoint_frontend in (False, True):
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run_step, args=(queue, args.network, batch_size,
+                                                               checkpoint_frontend, args.steps, args.num_threads, args.fs))
+            p.start()
+            results.append(queue.get())
+            p.join()
+        print('{:6d} {:14.0f} {:14.0f} {:9.2f}s {:9.2f}s'.format(
+            batch_size, results[0][0], results[1][0], results[0][1], results[1][1]))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+random crop throughput against the sparsity of the clips.
+
+usage:
+    python bench_loader.py
+    python bench_loader.py --loud=1.0,0.5,0.1,0.02 --samples=2000
+
+each synthetic clip is quiet except for one burst of --loud x clip length at a random
+position. 'rejection' is the former random_selection, redrawing a start until the crop
+is loud enough; 'index' draws from data_process.WindowIndex, built once per dataset.
+
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+from data_process import *
+from util import *
+from bench_suite import synthetic_store
+
+
+def rejection_selection(wave, window_size):
+    wl = len(wave) - window_size
+    maxamp = 0.
+    while maxamp < 0.005:
+        win_start = random.randint(0, wl)
+        win_data = wave[win_start: win_start + window_size]
+        maxamp = np.max(np.abs(win_data))
+    return win_data
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='random crop throughput against clip sparsity')
+    parser.add_argument('--loud', type=str, default='1.0,0.5,0.35,0.1,0.02',
+                        help='fractions of the clip covered by the loud burst')
+    parser.add_argument('--num_clips', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=2000, help='crops drawn per method')
+    parser.add_argument('--window_size', type=int, default=66150)
+    args = parser.parse_args()
+
+    print('{:>6s} {:>12s} {:>16s} {:>16s} {:>8s}'.format(
+        'loud', 'index(s)', 'rejection(/s)', 'index(/s)', 'speedup'))
+    for loud in [float(l) for l in args.loud.split(',')]:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            synthetic_store(tmp_dir, args.num_clips, loud=loud)
+            store, indices = open_fold(tmp_dir, 0, 'train')
+            data = store['data']
+
+            start = time.time()
+            window_index = WindowIndex(data, indices, args.window_size)
+            build = time.time() - start
+
+            positions = np.random.randint(0, len(indices), args.samples)
+
+            start = time.time()
+            for pos in positions:
+                rejection_selection(data[indices[pos]], args.window_size)
+            rejection = args.samples / (time.time() - start)
+
+            start = time.time()
+            for pos in positions:
+                win_start = window_index.sample(pos)
+                np.array(data[indices[pos]][win_start: win_start + args.window_size])
+            index = args.samples / (time.time() - start)
+
+            print('{:6.2f} {:12.3f} {:16.0f} {:16.0f} {:7.1f}x'.format(loud, build, rejection, index, index / rejection))
+            del store, data
+        finally:
+            shutil.rmtree(tmp_dir)
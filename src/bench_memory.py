@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+memory of the training DataLoader against num_workers, for each way of holding the waveforms.
+
+usage:
+    python bench_memory.py --store=../data_wave_44100 --fold=0
+    python bench_memory.py --num_clips=400   (synthetic store in a temporary directory)
+
+modes:
+    list    - one numpy array per clip, like the former pickled list of dicts
+    memmap  - util.load_store, the waveforms are memory-mapped
+    shared  - util.share_store, one shared memory tensor (main.py --shared_memory)
+
+RSS counts shared pages once per process, PSS splits them between the processes
+that map them, Private is what each process holds alone (e.g. copy-on-write copies).
+
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import numpy as np
+from torch.utils.data import DataLoader
+from data_process import *
+from util import *
+from bench_suite import synthetic_store
+
+
+def smaps(pid):
+    """
+    :return: {'Rss', 'Pss', 'Private'} of a process in MB.
+    """
+    mem = {'Rss': 0., 'Pss': 0., 'Private': 0.}
+    with open('/proc/{}/smaps_rollup'.format(pid), 'r') as f:
+        for line in f:
+            field, value = line.split(':', 1)
+            kb = float(value.split()[0]) if value.strip().endswith('kB') else 0.
+            if field in ('Rss', 'Pss'):
+                mem[field] += kb / 1024
+            elif field in ('Private_Clean', 'Private_Dirty'):
+                mem['Private'] += kb / 1024
+    return mem
+
+
+def children(pid):
+    pids = []
+    for p in os.listdir('/proc'):
+        if not p.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(p), 'r') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError):
+            continue
+        if ppid == pid:
+            pids.append(int(p))
+    return pids
+
+
+def open_mode(store_dir, mode):
+    store = load_store(store_dir)
+    if mode == 'list':
+        store['data'] = [np.array(row) for row in store['data']]
+    elif mode == 'shared':
+        store = share_store(store)
+    return store
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='DataLoader memory against num_workers')
+    parser.add_argument('--store', type=str, help='store directory (default: synthetic store)')
+    parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--num_clips', type=int, default=400, help='clips of the synthetic store')
+    parser.add_argument('--modes', type=str, default='list,memmap,shared')
+    parser.add_argument('--workers', type=str, default='0,1,2,4,8')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=20, help='batches loaded before measuring')
+    args = parser.parse_args()
+
+    tmp_dir = None
+    store_dir = args.store
+    if store_dir is None:
+        tmp_dir = tempfile.mkdtemp()
+        store_dir = tmp_dir
+        synthetic_store(store_dir, args.num_clips)
+
+    print('{:8s} {:>8s} {:>10s} {:>10s} {:>12s}'.format('mode', 'workers', 'RSS(MB)', 'PSS(MB)', 'Private(MB)'))
+    try:
+        for mode in args.modes.split(','):
+            store = open_mode(store_dir, mode)
+            dataset = WaveformDataset(store, args.fold, 'train', transform=ToTensor())
+            for num_workers in [int(w) for w in args.workers.split(',')]:
+                loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=num_workers)
+                it = iter(loader)
+                for _ in range(min(args.batches, len(loader))):
+                    next(it)
+
+                total = {'Rss': 0., 'Pss': 0., 'Private': 0.}
+                for pid in [os.getpid()] + children(os.getpid()):
+                    for k, v in smaps(pid).items():
+                        total[k] += v
+                print('{:8s} {:8d} {:10.0f} {:10.0f} {:12.0f}'.format(
+                    mode, num_workers, total['Rss'], total['Pss'], total['Private']))
+                del it
+            del dataset, store
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
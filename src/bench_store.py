@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+size, read throughput and accuracy of compact (int16 / float16) waveform stores.
+
+usage:
+    python bench_store.py --store=../data_wave_44100 --model='../model/WaveMsNet_fold{}_epoch160.pkl'
+    python bench_store.py --num_clips=100   (synthetic store, untrained WaveMsNet)
+
+the float32 store is converted to each dtype in a temporary directory (as
+data_transform.py --dtype would write it). For each dtype: MB per clip, SNR of the
+decoded waveforms against float32, random training windows read per second by
+WaveformDataset, the largest logit difference to the float32 store, and the test
+accuracy of each fold (window_scores, as main.test).
+
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import torch
+from data_process import *
+from inference import window_scores
+from util import *
+import network
+from bench_suite import synthetic_store
+
+
+def convert_store(store, dirname, dtype):
+    """
+    write the clips of a float32 store as a compact store, with the same folds.
+    """
+    data = create_store(dirname, len(store['label']), store['data'].shape[1], dtype)
+    scales = []
+    for clip in range(len(data)):
+        samples, scale = encode_clip(store['data'][clip], dtype)
+        data[clip] = samples
+        scales.append(scale)
+    close_store(dirname, data, store['label'], store['key'], scales)
+    for fold_num in range(5):
+        for split in ('train', 'test'):
+            save_fold(dirname, fold_num, split, load_fold(store['dir'], fold_num, split))
+
+
+def snr(store, ref):
+    signal = noise = 0.
+    for clip in range(len(ref['label'])):
+        x = np.asarray(ref['data'][clip], dtype=np.float64)
+        y = decode_window(store['data'][clip], store['scale'][clip]).astype(np.float64)
+        signal += np.sum(x ** 2)
+        noise += np.sum((x - y) ** 2)
+    return 10 * np.log10(signal / noise) if noise > 0 else float('inf')
+
+
+def read_throughput(store, samples=2000):
+    dataset = WaveformDataset(store, 0, 'train')
+    positions = np.random.randint(0, len(dataset), samples)
+    start = time.time()
+    for pos in positions:
+        dataset[pos]
+    return samples / (time.time() - start)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compact waveform stores against float32')
+    parser.add_argument('--store', type=str, default=None, help='float32 store (default: synthetic store)')
+    parser.add_argument('--model', type=str, default=None,
+                        help='trained model path, {} is replaced by the fold number (default: untrained WaveMsNet)')
+    parser.add_argument('--dtypes', type=str, default='float32,int16,float16')
+    parser.add_argument('--num_clips', type=int, default=100, help='clips of the synthetic store')
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if args.store is None:
+            synthetic_store(os.path.join(tmp_dir, 'float32'), args.num_clips, args.fs)
+            ref = load_store(os.path.join(tmp_dir, 'float32'))
+        else:
+            ref = load_store(args.store)
+        models = [load_model(args.model.format(fold_num)) if args.model else network.WaveMsNet(args.fs).eval()
+                  for fold_num in range(5)]
+
+        win_size = window_length(args.fs)
+        stride = int(args.fs * 0.2)
+        ref_scores = None
+        print('{:>8s} {:>8s} {:>8s} {:>11s} {:>12s}   {}'.format(
+            'dtype', 'MB/clip', 'SNR(dB)', 'windows/s', 'max|dlogit|', 'test acc fold 0-4'))
+        for dtype in args.dtypes.split(','):
+            if dtype == 'float32':
+                store = ref
+            else:
+                convert_store(ref, os.path.join(tmp_dir, dtype), np.dtype(dtype))
+                store = load_store(os.path.join(tmp_dir, dtype))
+
+            accs = []
+            scores = []
+            for fold_num, model in enumerate(models):
+                indices = load_fold(store['dir'], fold_num, 'test')
+                s, num_wins = window_scores(model, store['data'], indices, win_size, stride, args.batch_size,
+                                            scale=store['scale'])
+                label = torch.from_numpy(store['label'][indices])
+                accs.append(100. * s.max(1)[1].eq(label).sum().item() / len(indices))
+                scores.append(s / torch.from_numpy(np.maximum(num_wins, 1)).float().unsqueeze(1))
+            if ref_scores is None:
+                ref_scores = scores
+            dlogit = max((s - r).abs().max().item() for s, r in zip(scores, ref_scores))
+
+            print('{:>8s} {:8.2f} {:8.1f} {:11.0f} {:12.2e}   {}'.format(
+                dtype, store['data'].nbytes / float(len(store['data'])) / 2.**20, snr(store, ref),
+                read_throughput(store), dlogit, ' '.join('{:.2f}'.format(a) for a in accs)))
+            del store
+    finally:
+        shutil.rmtree(tmp_dir)
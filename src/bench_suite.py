@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+throughput of the networks and datasets on synthetic data, with a regression compare.
+
+usage:
+    python bench_suite.py --out=../log/bench_base.json
+    python bench_suite.py --out=../log/bench_new.json --compare=../log/bench_base.json
+    python bench_suite.py --fs=16000 --batch_sizes=8 --threads=1 --only='WaveMsNet/'
+
+no dataset is needed: the networks run on random windows of the right shape, and the
+datasets read a synthetic store of random clips written to a temporary directory.
+
+cases:
+    network/<class>/<mode>/bs<batch>/t<threads>
+        mode: forward (train mode), backward (forward + backward) or inference
+        (eval mode, no_grad). LogMel and QuantWaveMsNet only run inference, the
+        fixed_logmel models run phase 1.
+    loader/<dataset>/w<num_workers>
+        samples/s of a DataLoader over WaveformDataset, FusionDataset or MFCCDataset,
+        after its first batch; the ms column is the time to the first batch.
+
+every case is stored as samples/s in --out. With --compare, each case found in both
+files is printed with its speed ratio; a case slower than the baseline by more than
+--tolerance is a regression, and the exit status is 1 if there is any.
+
+"""
+import argparse
+import json
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+import network
+from data_process import *
+from quantize import quantize
+from util import *
+
+
+NETWORKS = ('LogMel', 'WaveMsNet', 'WaveMsNet_Logmel', 'QuantWaveMsNet', 'WaveMsNet_srf_fixed_logmel',
+            'WaveMsNet_mrf_fixed_logmel', 'WaveMsNet_lrf_fixed_logmel', 'WaveMsNet_fixed_logmel')
+MODES = ('forward', 'backward', 'inference')
+DATASETS = ('WaveformDataset', 'FusionDataset', 'MFCCDataset')
+INFERENCE_ONLY = ('LogMel', 'QuantWaveMsNet')
+
+
+def build_network(name, fs):
+    """
+    :return: model, shape of one input example (without the batch dimension).
+    """
+    win_size = window_length(fs)
+    if name == 'LogMel':
+        return network.LogMel(fs), (1, win_size)
+    if name == 'WaveMsNet_Logmel':
+        return network.WaveMsNet_Logmel(fs), (1, 96, win_size // frontend_hop(fs))
+    if name == 'QuantWaveMsNet':
+        model = network.WaveMsNet(fs).eval()
+        calib = [(torch.randn(8, 1, win_size), None) for _ in range(2)]
+        return quantize(model, calib, calib_batches=2), (1, win_size)
+    return getattr(network, name)(fs=fs), (1, win_size)
+
+
+def time_network(model, shape, mode, batch_size, repeats):
+    """
+    :return: median seconds of one step.
+    """
+    x = torch.randn((batch_size,) + shape)
+    label = torch.zeros(batch_size, dtype=torch.long)
+    if mode == 'inference':
+        model.eval()
+    else:
+        model.train()
+
+    def step():
+        if mode == 'inference':
+            with torch.no_grad():
+                model(x)
+        elif mode == 'forward':
+            model(x)
+        else:
+            model.zero_grad()
+            F.cross_entropy(model(x), label).backward()
+
+    step()  # warm up
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        step()
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def synthetic_store(dirname, num_clips, fs=44100, loud=None, dtype='float32'):
+    """
+    write a store of random 5s clips with random labels of 50 classes, shared by the bench scripts.
+
+    fold k tests the clips i with i % 5 == k and trains on the others.
+    :param loud: None: a quiet clip with one loud burst from a random start, decaying like a
+                 natural sound. A fraction: the clip is quiet except for one burst of noise
+                 covering loud x clip length at a random position, see bench_loader.py.
+    :param dtype: 'float32', or 'int16'/'float16' for a compact store (util.encode_clip).
+    """
+    num_samples = 5 * fs
+    data = create_store(dirname, num_clips, num_samples, np.dtype(dtype))
+    scales = []
+    for i in range(num_clips):
+        wave = 0.001 * np.random.randn(num_samples)
+        if loud is None:
+            start = np.random.randint(0, num_samples // 2)
+            wave[start:] += np.random.uniform(0.05, 0.5) * np.random.randn(num_samples - start) * \
+                np.exp(-np.arange(num_samples - start) / (0.2 * num_samples))
+        else:
+            burst = max(1, int(loud * num_samples))
+            start = np.random.randint(0, num_samples - burst + 1)
+            wave[start: start + burst] = 0.1 * np.random.randn(burst)
+        samples, scale = encode_clip(wave.astype(np.float32), np.dtype(dtype))
+        data[i] = samples
+        scales.append(scale)
+    close_store(dirname, data, np.random.randint(0, 50, num_clips), ['clip' + str(i) for i in range(num_clips)],
+                scales if dtype != 'float32' else None)
+    for fold_num in range(5):
+        save_fold(dirname, fold_num, 'train', [i for i in range(num_clips) if i % 5 != fold_num])
+        save_fold(dirname, fold_num, 'test', [i for i in range(num_clips) if i % 5 == fold_num])
+
+
+def time_loader(dataset, batch_size, num_workers, batches):
+    """
+    :return: seconds to the first batch, samples/s of the following batches.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    start = time.time()
+    it = iter(loader)
+    next(it)
+    startup = time.time() - start
+    start = time.time()
+    samples = 0
+    for _ in range(batches):
+        try:
+            batch = next(it)
+        except StopIteration:
+            it = iter(loader)
+            batch = next(it)
+        samples += len(batch[-1])
+    elapse = time.time() - start
+    del it
+    return startup, samples / elapse
+
+
+def compare(results, baseline, tolerance):
+    """
+    print the speed ratio of every case in both runs.
+    :return: names of the cases slower than the baseline by more than tolerance.
+    """
+    regressions = []
+    print('{:<52s} {:>12s} {:>12s} {:>7s}'.format('case', 'base(/s)', 'new(/s)', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base, new = baseline[name]['samples_per_s'], result['samples_per_s']
+        ratio = new / base
+        slower = ratio < 1 - tolerance
+        if slower:
+            regressions.append(name)
+        print('{:<52s} {:12.1f} {:12.1f} {:6.2f}x{}'.format(name, base, new, ratio, '  REGRESSION' if slower else ''))
+    missing = [name for name in baseline if name not in results]
+    if missing:
+        print('{} cases of the baseline were not run'.format(len(missing)))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='network and dataset throughput on synthetic data')
+    parser.add_argument('--networks', type=str, default=','.join(NETWORKS))
+    parser.add_argument('--modes', type=str, default=','.join(MODES))
+    parser.add_argument('--batch_sizes', type=str, default='1,8,32')
+    parser.add_argument('--threads', type=str, default=None, help='torch threads, default 1 and all cores')
+    parser.add_argument('--repeats', type=int, default=5, help='timed steps per case, the median is kept')
+    parser.add_argument('--datasets', type=str, default=','.join(DATASETS))
+    parser.add_argument('--num_workers', type=str, default='0,2,4')
+    parser.add_argument('--num_clips', type=int, default=64, help='clips of the synthetic store')
+    parser.add_argument('--store_dtype', type=str, default='float32', help='float32, int16 or float16')
+    parser.add_argument('--loader_batch_size', type=int, default=32)
+    parser.add_argument('--loader_batches', type=int, default=8)
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--only', type=str, default=None, help='regex, run only the cases it matches')
+    parser.add_argument('--out', type=str, default=None, help='JSON file of the results')
+    parser.add_argument('--compare', type=str, default=None, help='JSON file of a baseline run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown tolerated by --compare')
+    args = parser.parse_args()
+
+    threads = [int(t) for t in args.threads.split(',')] if args.threads else \
+        sorted(set([1, torch.get_num_threads()]))
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    modes = args.modes.split(',')
+
+    def selected(name):
+        return args.only is None or re.search(args.only, name) is not None
+
+    results = OrderedDict()
+    print('{:<52s} {:>10s} {:>12s}'.format('case', 'ms', 'samples/s'))
+
+    default_threads = torch.get_num_threads()
+    for name in [n for n in args.networks.split(',') if n]:
+        cases = [(mode, num_threads, batch_size) for mode in modes for num_threads in threads
+                 for batch_size in batch_sizes
+                 if (mode == 'inference' or name not in INFERENCE_ONLY) and
+                 selected('network/{}/{}/bs{}/t{}'.format(name, mode, batch_size, num_threads))]
+        if not cases:
+            continue
+        model, shape = build_network(name, args.fs)
+        for mode, num_threads, batch_size in cases:
+            torch.set_num_threads(num_threads)
+            case = 'network/{}/{}/bs{}/t{}'.format(name, mode, batch_size, num_threads)
+            elapse = time_network(model, shape, mode, batch_size, args.repeats)
+            results[case] = {'ms': 1000 * elapse, 'samples_per_s': batch_size / elapse}
+            print('{:<52s} {:10.1f} {:12.1f}'.format(case, 1000 * elapse, batch_size / elapse))
+    torch.set_num_threads(default_threads)
+
+    loaders = [(name, int(w)) for name in args.datasets.split(',') if name for w in args.num_workers.split(',')
+               if selected('loader/{}/w{}'.format(name, w))]
+    if loaders:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            synthetic_store(tmp_dir, args.num_clips, args.fs, dtype=args.store_dtype)
+            for name, num_workers in loaders:
+                dataset = globals()[name](tmp_dir, 0, 'train', fs=args.fs,
+                                          transform=ToTensor2() if name == 'FusionDataset' else ToTensor())
+                case = 'loader/{}/w{}'.format(name, num_workers)
+                startup, speed = time_loader(dataset, args.loader_batch_size, num_workers, args.loader_batches)
+                results[case] = {'startup_s': startup, 'samples_per_s': speed}
+                print('{:<52s} {:10.1f} {:12.1f}'.format(case, 1000 * startup, speed))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    if args.out:
+        meta = OrderedDict([('date', time.strftime('%Y-%m-%d %H:%M:%S')), ('torch', torch.__version__),
+                            ('python', platform.python_version()), ('machine', platform.machine()),
+                            ('processor', platform.processor()), ('cores', torch.get_num_threads()),
+                            ('fs', args.fs), ('store_dtype', args.store_dtype)])
+        with open(args.out, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+        print('results saved as: {}'.format(args.out))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print('\ncompared with {} ({})'.format(args.compare, baseline['meta']['date']))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('{} regressions over {:.0f}%'.format(len(regressions), 100 * args.tolerance))
+            sys.exit(1)
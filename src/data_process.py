@@ -10,99 +10,177 @@ import numpy as np
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms, utils
 import librosa
+import threading
+import time
+from queue import Queue
 from util import *
+from network import LogMel
+from feature_cache import FeatureCache
 import random
 
 
+def open_fold(store, fold_num, split):
+    """
+    :param store: store dict from util.load_store, or its directory.
+    :return: the store and the clip indices of the fold split.
+    all folds built on the same store dict share one memory-mapped copy of the waveforms.
+    """
+    if not isinstance(store, dict):
+        store = load_store(store)
+    return store, load_fold(store['dir'], fold_num, split)
+
+
+class WindowIndex(object):
+    """
+    non-silent window starts of each clip, built once when the dataset is created.
+
+    random crops are drawn from it directly instead of redrawing until the crop
+    is loud enough, so the cost does not depend on how sparse a clip is.
+    """
+    def __init__(self, data, clips, window_size, threshold=0.005, scale=None):
+        """
+        :param data: (num_clips, num_samples) waveforms, e.g. store['data']
+        :param clips: rows of data, crops are drawn by position in clips.
+        :param scale: store['scale'] of a compact store, the threshold is compared in stored units.
+        """
+        self.runs = []
+        for clip in clips:
+            t = threshold if scale is None else threshold / scale[clip]
+            starts, lengths = window_runs(data[clip], window_size, t)
+            self.runs.append((starts, np.cumsum(lengths)))
+
+    def sample(self, pos):
+        """
+        :return: a uniformly drawn non-silent window start of clip clips[pos].
+        """
+        starts, ends = self.runs[pos]
+        r = random.randrange(ends[-1])
+        k = np.searchsorted(ends, r, side='right')  # run holding the r-th valid start
+        return starts[k] + r - (ends[k - 1] if k > 0 else 0)
+
+
 class WaveformDataset(Dataset):
 # }}}
-    def __init__(self, pkl_file, window_size=66150, fs=44100, train_slices=1, add_logmel=False, transform=None):
+    def __init__(self, store, fold_num, split='train', window_size=None, fs=44100, train_slices=1, add_logmel=False,
+                 crops_per_sample=1, transform=None):
         """
-        :param pkl_file: 
-        :param window_size: 
+        :param store: waveform store written by data_transform.get_store, see open_fold.
+        :param fold_num: 
+        :param split: 'train' or 'test'
+        :param window_size: default util.window_length(fs), 66150 at 44.1kHz
+        :param fs: sample rate of the store
         :param num_slices: slices number of one record divide into.
+        :param crops_per_sample: random crops of the clip returned by one sample, stacked if > 1.
         :param transform: 
         """
 
         self.transform = transform
-        self.sampleSet = load_data(pkl_file)
-        self.window_size = window_size
+        self.store, self.indices = open_fold(store, fold_num, split)
+        self.window_size = window_size or window_length(fs)
         self.fs = fs
         self.train_slices = train_slices
         self.add_logmel = add_logmel
+        if add_logmel:
+            self.logmel = LogMel(fs)
+        self.crops_per_sample = crops_per_sample
+        self.window_index = WindowIndex(self.store['data'], self.indices, self.window_size,
+                                        scale=self.store['scale'])
 
     def __len__(self):
-        return len(self.sampleSet)*self.train_slices
+        return len(self.indices)*self.train_slices
 
     def __getitem__(self, index):
 
         # key = self.sampleSet[index//self.num_slices]['key']
 
-        data = self.sampleSet[index // self.train_slices]['data']
-        feat = self.random_selection(data)
-        label = self.sampleSet[index // self.train_slices]['label']
+        pos = index // self.train_slices
+        clip = self.indices[pos]
+        # a row of the memmap, windows are sliced from it zero-copy.
+        data = self.store['data'][clip]
+        label = int(self.store['label'][clip])
 
+        feats = [self.get_feat(self.random_selection(data, pos)) for _ in range(self.crops_per_sample)]
+        feat = feats[0] if self.crops_per_sample == 1 else np.stack(feats)
+        sample = {'feat': feat, 'label': label}
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+    def get_feat(self, feat):
         if self.add_logmel == False:
             feat = feat[np.newaxis, :]
-            sample = {'feat': feat, 'label': label}
         else:
-            melspec = librosa.feature.melspectrogram(feat, self.fs, n_fft=2048, hop_length=150//(self.fs//44100), n_mels=96)  # (40, 442)
-            logmel = librosa.logamplitude(melspec)[:,:441]  # (40, 441)
+            # per sample in the workers; to compute it per batch, leave add_logmel off
+            # and put network.LogMel in front of the model
+            with torch.no_grad():
+                logmel = self.logmel(torch.from_numpy(np.ascontiguousarray(feat)).view(1, -1))  # (1, 1, 96, 441)
 
             # delta = librosa.feature.delta(logmel, width=3) # (40, 441)
 
             # feat = np.stack((logmel, delta))
 
-            # sample = {'feat': feat, 'label': label}
-            feat = logmel[np.newaxis, :, :]
-            sample = {'feat': feat, 'label': label}
-
-        if self.transform:
-            sample = self.transform(sample)
-
-        return sample
-
-    def random_selection(self, wave):
-        wl = len(wave) - self.window_size
-        maxamp = 0.
+            feat = logmel[0].numpy()
+        return feat
 
-        # win_start = random.randint(0, wl)
-        # win_data = wave[win_start: win_start + self.window_size]
-
-        while maxamp < 0.005:
-            win_start = random.randint(0, wl)
-            win_data = wave[win_start: win_start + self.window_size]
-            maxamp = np.max(np.abs(win_data))
-        return win_data
+    def random_selection(self, wave, pos):
+        win_start = self.window_index.sample(pos)
+        # only the window is converted from the storage dtype
+        return decode_window(wave[win_start: win_start + self.window_size], self.store['scale'][self.indices[pos]])
 
 #}}}
 
 
 class LogMelDataset(Dataset):
 # }}}
-    def __init__(self, pkl_file, transform=None):
+    def __init__(self, store, fold_num, split='train', window_size=None, stride=None, fs=44100, train_slices=1,
+                 cache_dir='../cache_feat', feats=('logmel',), transform=None):
         """
-        :param pkl_file: 
-        :param window_size: 
+        :param store: waveform store written by data_transform.get_store, see open_fold.
+        :param fold_num: 
+        :param split: 'train' or 'test'
+        :param window_size: default util.window_length(fs), 66150 at 44.1kHz
+        :param stride: crops start on this grid, so their features can be cached. default 0.2s
+        :param fs: sample rate of the store
         :param num_slices: slices number of one record divide into.
+        :param cache_dir: feature_cache.FeatureCache directory, filled on the first epoch
+                          (or beforehand by data_transform.get_spec).
+        :param feats: 'logmel', 'delta' or 'mfcc', stacked as channels.
         :param transform: 
         """
 
         self.transform = transform
-        self.sampleSet = load_data(pkl_file)
+        self.store, self.indices = open_fold(store, fold_num, split)
+        self.window_size = window_size = window_size or window_length(fs)
+        stride = stride or int(fs * 0.2)
+        self.train_slices = train_slices
+        self.feats = feats
+        self.cache = FeatureCache(cache_dir, fs=fs, store_dtype=self.store['data'].dtype)
+
+        # non-silent crop starts on the grid, as data_transform.get_spec
+        self.starts = []
+        for clip in self.indices:
+            maxamp = window_maxamp(self.store['data'][clip], window_size, stride) * self.store['scale'][clip]
+            keep = np.flatnonzero(maxamp >= 0.005)
+            self.starts.append(keep * stride if len(keep) else np.array([0]))
 
     def __len__(self):
-        return len(self.sampleSet)
+        return len(self.indices)*self.train_slices
 
     def __getitem__(self, index):
 
-        # key = self.sampleSet[index//self.num_slices]['key']
+        pos = index // self.train_slices
+        clip = self.indices[pos]
+        start = int(random.choice(self.starts[pos]))
+        wave = self.store['data'][clip]
+        win = decode_window(wave[start: start + self.window_size], self.store['scale'][clip])
+        cached = self.cache.get(self.store['key'][clip], win, start)
 
-        feat = self.sampleSet[index]['logmel']
-        feat = feat[np.newaxis, :]
+        feat = np.stack([cached[name] for name in self.feats])  # (len(feats), 96L, 441L)
         # print feat.shape
 
-        label = self.sampleSet[index]['label']
+        label = int(self.store['label'][clip])
         sample = {'feat': feat, 'label': label}
 
         if self.transform:
@@ -114,90 +192,169 @@ class LogMelDataset(Dataset):
 
 class FusionDataset(Dataset):
 # }}}
-    def __init__(self, pkl_file, window_size=66150, train_slices=1, transform=None):
+    def __init__(self, store, fold_num, split='train', window_size=None, fs=44100, train_slices=1, crops_per_sample=1,
+                 transform=None):
         """
-        :param pkl_file: 
-        :param window_size: 
+        :param store: waveform store written by data_transform.get_store, see open_fold.
+        :param fold_num: 
+        :param split: 'train' or 'test'
+        :param window_size: default util.window_length(fs), 66150 at 44.1kHz
+        :param fs: sample rate of the store
         :param num_slices: slices number of one record divide into.
+        :param crops_per_sample: random crops of the clip returned by one sample, stacked if > 1.
         :param transform: 
         """
 
         self.transform = transform
-        self.sampleSet = load_data(pkl_file)
-        self.window_size = window_size
+        self.store, self.indices = open_fold(store, fold_num, split)
+        self.window_size = window_size or window_length(fs)
         self.train_slices = train_slices
+        self.crops_per_sample = crops_per_sample
+        self.logmel = LogMel(fs)
+        self.window_index = WindowIndex(self.store['data'], self.indices, self.window_size,
+                                        scale=self.store['scale'])
 
     def __len__(self):
-        return len(self.sampleSet)*self.train_slices
+        return len(self.indices)*self.train_slices
 
     def __getitem__(self, index):
 
         # key = self.sampleSet[index//self.num_slices]['key']
 
-        data = self.sampleSet[index // self.train_slices]['data']
-        wave = self.random_selection(data)
-        label = self.sampleSet[index // self.train_slices]['label']
+        pos = index // self.train_slices
+        clip = self.indices[pos]
+        # a row of the memmap, windows are sliced from it zero-copy.
+        data = self.store['data'][clip]
+        label = int(self.store['label'][clip])
+
+        waves = []
+        feats = []
+        for _ in range(self.crops_per_sample):
+            wave = self.random_selection(data, pos)
+            feats.append(self.get_feat(wave))
+            waves.append(wave[np.newaxis, :])
+
+        if self.crops_per_sample == 1:
+            sample = {'wave': waves[0], 'feat': feats[0], 'label': label}
+        else:
+            sample = {'wave': np.stack(waves), 'feat': np.stack(feats), 'label': label}
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
 
-        melspec = librosa.feature.melspectrogram(wave, 44100, n_fft=2048, hop_length=150, n_mels=96)  # (40, 442)
-        logmel = librosa.logamplitude(melspec)[:,:441]  # (40, 441)
+    def get_feat(self, wave):
+        with torch.no_grad():
+            logmel = self.logmel(torch.from_numpy(np.ascontiguousarray(wave)).view(1, -1))[0, 0].numpy()  # (96, 441)
         # mfcc = librosa.feature.mfcc(wave, n_fft=2048, hop_length=150, sr=44100, n_mfcc=32)
         # mfcc = mfcc[:, :441]
         # delta = librosa.feature.delta(logmel) # (40, 441)
         # feat = np.stack((logmel, mfcc, delta))
-        feat = logmel[np.newaxis, :, :]
+        return logmel[np.newaxis, :, :]
+
+    def random_selection(self, wave, pos):
+        win_start = self.window_index.sample(pos)
+        # only the window is converted from the storage dtype
+        return decode_window(wave[win_start: win_start + self.window_size], self.store['scale'][self.indices[pos]])
 
-        wave = wave[np.newaxis, :]
-        sample = {'wave': wave, 'feat': feat, 'label': label}
+
+class FrontendCacheDataset(Dataset):
+# }}}
+    def __init__(self, frontend_cache, feature_cache, store, clips, train_slices=1, transform=None):
+        """
+        phase-2 samples: cached frontend map and log-mel feature of a random crop of a clip.
+
+        :param frontend_cache: feature_cache.FrontendCache built on the same clips.
+        :param feature_cache: feature_cache.FeatureCache for the log-mel features.
+        :param store: store dict from util.load_store
+        :param clips: rows of the store, e.g. the indices of a fold split.
+        :param transform: ToTensor2, 'wave' is the (1, 96, 441) frontend map.
+        """
+
+        self.transform = transform
+        self.frontend_cache = frontend_cache
+        self.feature_cache = feature_cache
+        self.store = store
+        self.indices = clips
+        self.train_slices = train_slices
+
+    def __len__(self):
+        return len(self.indices)*self.train_slices
+
+    def __getitem__(self, index):
+
+        row = random.choice(self.frontend_cache.rows[index // self.train_slices])
+        sample = self.crop(row)
 
         if self.transform:
             sample = self.transform(sample)
 
         return sample
 
-    def random_selection(self, wave):
-        wl = len(wave) - self.window_size
-        maxamp = 0.
-
-        # win_start = random.randint(0, wl)
-        # win_data = wave[win_start: win_start + self.window_size]
-
-        while maxamp < 0.005:
-            win_start = random.randint(0, wl)
-            win_data = wave[win_start: win_start + self.window_size]
-            maxamp = np.max(np.abs(win_data))
-        return win_data
+    def crop(self, row):
+        """
+        :param row: row of the frontend cache.
+        """
+        clip, start = self.frontend_cache.crops[row]
+        win = decode_window(self.store['data'][clip][start: start + self.frontend_cache.win_size],
+                            self.store['scale'][clip])
+        logmel = self.feature_cache.get(self.store['key'][clip], win, start)['logmel']
+        return {'wave': np.array(self.frontend_cache.maps[row])[np.newaxis],
+                'feat': np.array(logmel)[np.newaxis],
+                'label': int(self.store['label'][clip])}
 
 
 class MFCCDataset(Dataset):
 # }}}
-    def __init__(self, pkl_file, window_size=66150, fs=44100, train_slices=1, add_logmel=False, transform=None):
+    def __init__(self, store, fold_num, split='train', window_size=None, fs=44100, train_slices=1, add_logmel=False,
+                 crops_per_sample=1, transform=None):
         """
-        :param pkl_file: 
-        :param window_size: 
+        :param store: waveform store written by data_transform.get_store, see open_fold.
+        :param fold_num: 
+        :param split: 'train' or 'test'
+        :param window_size: default util.window_length(fs), 66150 at 44.1kHz
+        :param fs: sample rate of the store
         :param num_slices: slices number of one record divide into.
+        :param crops_per_sample: random crops of the clip returned by one sample, stacked if > 1.
         :param transform: 
         """
         self.transform = transform
-        self.sampleSet = load_data(pkl_file)
-        self.window_size = window_size
+        self.store, self.indices = open_fold(store, fold_num, split)
+        self.window_size = window_size or window_length(fs)
         self.fs = fs
         self.train_slices = train_slices
         self.add_logmel = add_logmel
+        self.crops_per_sample = crops_per_sample
+        self.window_index = WindowIndex(self.store['data'], self.indices, self.window_size,
+                                        scale=self.store['scale'])
 
     def __len__(self):
-        return len(self.sampleSet)*self.train_slices
+        return len(self.indices)*self.train_slices
 
     def __getitem__(self, index):
 
         # key = self.sampleSet[index//self.num_slices]['key']
 
-        data = self.sampleSet[index // self.train_slices]['data']
-        feat = self.random_selection(data)
-        label = self.sampleSet[index // self.train_slices]['label']
+        pos = index // self.train_slices
+        clip = self.indices[pos]
+        # a row of the memmap, windows are sliced from it zero-copy.
+        data = self.store['data'][clip]
+        label = int(self.store['label'][clip])
+
+        feats = [self.get_feat(self.random_selection(data, pos)) for _ in range(self.crops_per_sample)]
+        feat = feats[0] if self.crops_per_sample == 1 else np.stack(feats)
+        sample = {'feat': feat, 'label': label}
 
+        if self.transform:
+            sample = self.transform(sample)
 
-        mfcc = librosa.feature.mfcc(y=feat, n_fft=2048, hop_length=150, sr=44100, n_mfcc=32)
-        mfcc = mfcc[:, :441]
+        return sample
+
+    def get_feat(self, feat):
+        hop = frontend_hop(self.fs)
+        mfcc = librosa.feature.mfcc(y=feat, n_fft=fft_size(self.fs), hop_length=hop, sr=self.fs, n_mfcc=32)
+        mfcc = mfcc[:, :len(feat) // hop]
             # melspec = librosa.feature.melspectrogram(feat, self.fs, n_fft=2048, hop_length=150/(self.fs//44100), n_mels=64)  # (40, 442)
             # logmel = librosa.logamplitude(melspec)[:,:441]  # (40, 441)
 
@@ -206,26 +363,171 @@ class MFCCDataset(Dataset):
             # feat = np.stack((logmel, delta))
 
             # sample = {'feat': feat, 'label': label}
-        feat = mfcc[np.newaxis, :, :]
-        sample = {'feat': feat, 'label': label}
+        return mfcc[np.newaxis, :, :]
 
-        if self.transform:
-            sample = self.transform(sample)
+    def random_selection(self, wave, pos):
+        win_start = self.window_index.sample(pos)
+        # only the window is converted from the storage dtype
+        return decode_window(wave[win_start: win_start + self.window_size], self.store['scale'][self.indices[pos]])
 
-        return sample
 
-    def random_selection(self, wave):
-        wl = len(wave) - self.window_size
-        maxamp = 0.
+def batch_buffer(field, batch_size, pin_memory=False):
+    """
+    :param field: one field of a sample, e.g. the feat or the label of ToTensor.
+    :return: empty (batch_size, *field.shape) tensor; (batch_size,) for one-element labels.
+    """
+    shape = () if field.numel() == 1 and not field.is_floating_point() else tuple(field.shape)
+    return torch.empty((batch_size,) + shape, dtype=field.dtype, pin_memory=pin_memory)
+
 
-        # win_start = random.randint(0, wl)
-        # win_data = wave[win_start: win_start + self.window_size]
+def collate_batch(samples, out=None):
+    """
+    DataLoader collate_fn writing each field of the samples straight into one batch tensor,
+    instead of stacking a list of per-sample tensors.
+
+    :param samples: tuples of tensors, e.g. (feat, label) of ToTensor.
+    :param out: tensors to write into, with at least len(samples) rows; allocated if None.
+    :return: list of (len(samples), ...) tensors, labels flattened to (len(samples),).
+    """
+    if out is None:
+        out = [batch_buffer(field, len(samples)) for field in samples[0]]
+    for i, sample in enumerate(samples):
+        for buf, field in zip(out, sample):
+            buf[i] = field
+    return [buf[:len(samples)] for buf in out]
 
-        while maxamp < 0.005:
-            win_start = random.randint(0, wl)
-            win_data = wave[win_start: win_start + self.window_size]
-            maxamp = np.max(np.abs(win_data))
-        return win_data
+
+class BatchPrefetcher(object):
+    """
+    batches of a dataset assembled in a background thread, up to depth batches
+    ahead of the train step.
+
+    with num_workers == 0 the thread loads the samples itself and writes them straight
+    into preallocated batch buffers (pinned with cuda) that are reused for the whole run.
+    With num_workers > 0 each worker collates its batch with collate_batch in its own
+    process, and that batch is passed on as is; with cuda it is pinned once, the same
+    copy as DataLoader(pin_memory=True). With cuda, batches are copied to the gpu on a
+    side stream into reused device buffers, so they arrive on the device ready to use.
+
+    wait is the time the train loop spent waiting for batches in the last epoch:
+    close to 0 when the model step, not the input pipeline, is the bottleneck.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, num_workers=0, depth=2, cuda=False):
+        """
+        :param dataset: samples are tuples of tensors, e.g. transform=ToTensor().
+        :return: iterating yields lists of tensors, one per field of the samples,
+                 valid until the next batch is requested.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.cuda = cuda
+        self.stream = torch.cuda.Stream() if cuda else None
+        # depth queued, one being filled and one held by the train step
+        self.slots = [{'bufs': None} for _ in range(depth + 2)]
+        self.wait = 0.
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def batches(self):
+        """
+        :return: yields lists of sample lists (num_workers == 0) or collated batches.
+        """
+        if self.num_workers > 0:
+            for batch in DataLoader(self.dataset, batch_size=self.batch_size, shuffle=self.shuffle,
+                                    num_workers=self.num_workers, collate_fn=collate_batch):
+                yield batch
+        else:
+            n = len(self.dataset)
+            order = np.random.permutation(n) if self.shuffle else np.arange(n)
+            for b in range(0, n, self.batch_size):
+                yield (self.dataset[i] for i in order[b: b + self.batch_size])
+
+    def fill(self, slot, batch):
+        """
+        :return: number of samples written into the slot.
+        """
+        if self.num_workers > 0:
+            # collated by the worker, no second copy into the slot
+            slot['bufs'] = [field.pin_memory() for field in batch] if self.cuda else batch
+            n = len(batch[0])
+        else:
+            n = 0
+            for sample in batch:
+                if slot['bufs'] is None:
+                    slot['bufs'] = [batch_buffer(field, self.batch_size, self.cuda) for field in sample]
+                for buf, field in zip(slot['bufs'], sample):
+                    buf[n] = field
+                n += 1
+
+        if self.cuda:
+            if 'device' not in slot:
+                slot['device'] = [torch.empty((self.batch_size,) + tuple(buf.shape[1:]), dtype=buf.dtype,
+                                              device='cuda') for buf in slot['bufs']]
+                slot['ready'] = torch.cuda.Event()
+            with torch.cuda.stream(self.stream):
+                if 'released' in slot:
+                    # the train step has finished reading the device buffers
+                    self.stream.wait_event(slot['released'])
+                for dst, src in zip(slot['device'], slot['bufs']):
+                    dst[:n].copy_(src[:n], non_blocking=True)
+                slot['ready'].record(self.stream)
+            # the pinned buffers are refilled only once the copy is done
+            slot['ready'].synchronize()
+        return n
+
+    def __iter__(self):
+        filled = Queue()
+        free = Queue()
+        for slot in self.slots:
+            free.put(slot)
+        end = object()
+        stop = threading.Event()
+        errors = []
+
+        def worker():
+            try:
+                for batch in self.batches():
+                    slot = free.get()
+                    if stop.is_set():
+                        return
+                    filled.put((slot, self.fill(slot, batch)))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                filled.put(end)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+        self.wait = 0.
+        held = None
+        try:
+            while True:
+                start = time.time()
+                item = filled.get()
+                self.wait += time.time() - start
+                if held is not None:
+                    if self.cuda:
+                        held['released'] = torch.cuda.Event()
+                        held['released'].record()
+                    free.put(held)
+                    held = None
+                if item is end:
+                    break
+                held, n = item
+                if self.cuda:
+                    torch.cuda.current_stream().wait_event(held['ready'])
+                yield [buf[:n] for buf in held['device' if self.cuda else 'bufs']]
+        finally:
+            # unblock the thread if the epoch is left early
+            stop.set()
+            free.put(None)
+        if errors:
+            raise errors[0]
 
 
 class ToTensor(object):
@@ -266,7 +568,7 @@ class ToTensor2(object):
 
 if __name__ == "__main__":
 
-    waveformDataset = WaveformDataset('../data_wave/fold0_valid.cPickle', add_logmel=True, transform=ToTensor())
+    waveformDataset = WaveformDataset('../data_wave_44100', 0, 'test', add_logmel=True, transform=ToTensor())
     dataloader = DataLoader(waveformDataset, batch_size=5, shuffle=False, num_workers=1)
 
     # metaDataset = MetaDataset('probilities.0.txt', transform=ToTensor())
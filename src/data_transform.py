@@ -1,8 +1,12 @@
 
 from util import *
+from feature_cache import FeatureCache
 import os
-import random
+import json
+import time
+import argparse
 import numpy as np
+from multiprocessing import Pool
 
 
 def get_fold_wavelist(fold_wavelist):
@@ -14,116 +18,178 @@ def get_fold_wavelist(fold_wavelist):
     return waveList
 
 
-def get_pkl(fs):
+def decode_audio(job):
     """
-    :return: [{'key', 'data', 'label'}, {}, {}... {}]
+    decode and resample one audio file, runs in the worker processes of ingest.
     """
+    f, fs, npyPath = job
+    audio_data, _ = librosa.load(f, fs)
+    np.save(npyPath, audio_data.astype(np.float32))
+    return f
 
-    wav_len = fs * 5
-
-    for fold_num in range(5):
-
-        print('get pkl on fold ', str(fold_num))
-        trainWaveName = '../cross_folds/evaluate-setup-ESC10/fold' + str(fold_num) + '_train.txt'
-        # validWaveName = '../evaluate-setup/fold' + str(fold_num) + '_valid.txt'
-        testWaveName = '../cross_folds/evaluate-setup-ESC10/fold' + str(fold_num) + '_test.txt'
-        trainWaveList = get_fold_wavelist(trainWaveName)
-        # validWaveList = get_fold_wavelist(validWaveName)
-        testWaveList = get_fold_wavelist(testWaveName)
-
-        # waveLists = [trainWaveList, validWaveList, testWaveList]
-        waveLists = [trainWaveList, testWaveList]
 
-        data = []
-        item = {}
+def save_manifest(manifestPath, manifest):
+    tmpPath = manifestPath + '.tmp'
+    with open(tmpPath, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(tmpPath, manifestPath)
 
-        for idx, wavelist in enumerate(waveLists):
-            for f in wavelist:
-                cls_id = f.split('/')[2].split(' ')[0]
 
-                # cls_id = num_to_id_ESC50(int(cls_id))
-                cls_id = num_to_id_ESC10(cls_id)
+def ingest(waveList, decodeDir, fs, num_workers=4):
+    """
+    decode each unique audio file once into decodeDir/<key>.npy with a pool of processes.
 
-                audio_data, _ = librosa.load(f, fs)
+    decodeDir/manifest.json maps each path to the mtime and fs it was decoded with,
+    so re-runs only decode new or changed files.
+    :return: {path: npy path}
+    """
 
-                # make each audio exactly 5s.
-                audio_data = audio_data[: wav_len]
+    if not os.path.exists(decodeDir):
+        os.makedirs(decodeDir)
+    manifestPath = os.path.join(decodeDir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath, 'r') as fp:
+            manifest = json.load(fp)
+
+    npyPaths = {}
+    jobs = []
+    for f in sorted(set(waveList)):
+        npyPath = os.path.join(decodeDir, f.split('/')[-1].split('.')[0] + '.npy')
+        npyPaths[f] = npyPath
+        entry = manifest.get(f)
+        if entry is not None and entry['mtime'] == os.path.getmtime(f) and entry['fs'] == fs \
+                and os.path.exists(npyPath):
+            continue
+        jobs.append((f, fs, npyPath))
+
+    print('ingest: {} files, {} to decode with {} workers'.format(len(npyPaths), len(jobs), num_workers))
+    if len(jobs) == 0:
+        return npyPaths
+
+    start = time.time()
+    pool = Pool(num_workers)
+    try:
+        for idx, f in enumerate(pool.imap_unordered(decode_audio, jobs, chunksize=4)):
+            manifest[f] = {'mtime': os.path.getmtime(f), 'fs': fs}
+            # checkpoint the manifest, an interrupted run resumes from here
+            if (idx + 1) % 200 == 0:
+                save_manifest(manifestPath, manifest)
+                print('decoded {}/{} files ({:.1f} files/s)'.format(
+                    idx + 1, len(jobs), (idx + 1) / (time.time() - start)))
+    finally:
+        pool.close()
+        pool.join()
+        save_manifest(manifestPath, manifest)
+
+    elapse = time.time() - start
+    print('decoded {} files in {:.1f}s ({:.1f} files/s)'.format(len(jobs), elapse, len(jobs) / elapse))
+    return npyPaths
+
+
+def store_dir(fs, dtype='float32'):
+    return '../data_wave_ESC10_' + str(fs) + ('' if dtype == 'float32' else '_' + dtype)
+
+
+def get_store(fs, num_workers=4, dtype='float32'):
+    """
+    store all clips once as a contiguous (num_clips, wav_len) array, see util.create_store.
+    each fold split is saved as an array of row indices into it.
+    :param dtype: 'float32', or 'int16' / 'float16' for a compact store with a scale per clip.
+    """
 
-                # audio_data = audio_data * 1.0 / np.max(abs(audio_data))
+    wav_len = fs * 5
+    storeDir = store_dir(fs, dtype)
 
-                if len(audio_data) < wav_len:
-                    audio_data = np.r_[audio_data, np.zeros(wav_len - len(audio_data))]
+    foldLists = []
+    for fold_num in range(5):
+        trainWaveName = '../cross_folds/evaluate-setup-ESC10/fold' + str(fold_num) + '_train.txt'
+        # validWaveName = '../evaluate-setup/fold' + str(fold_num) + '_valid.txt'
+        testWaveName = '../cross_folds/evaluate-setup-ESC10/fold' + str(fold_num) + '_test.txt'
+        foldLists.append((get_fold_wavelist(trainWaveName), get_fold_wavelist(testWaveName)))
 
-                item['label'] = int(cls_id)
-                item['key'] = f.split('/')[-1].split('.')[0]
-                item['data'] = audio_data
+    # every clip is in four train lists and one test list, decode and store it only once.
+    waveList = sorted(set(f for lists in foldLists for wavelist in lists for f in wavelist))
+    npyPaths = ingest(waveList, os.path.join(storeDir, 'decoded'), fs, num_workers)
 
-                data.append(item)
-                item = {}
+    data = create_store(storeDir, len(waveList), wav_len, np.dtype(dtype))
+    labels = []
+    keys = []
+    scales = []
 
-            if idx == 0:
-                random.shuffle(data)
-                save_data('../data_wave_ESC10_'+ str(fs) +'/fold'+str(fold_num)+'_train.cPickle', data)
-            # elif idx == 1:
-            #     save_data('../data_wave_'+ str(fs) +'/fold' + str(fold_num) + '_valid.cPickle', data)
-            elif idx == 1:
-                save_data('../data_wave_ESC10_'+ str(fs) +'/fold' + str(fold_num) + '_test.cPickle', data)
+    for idx, f in enumerate(waveList):
+        cls_id = f.split('/')[2].split(' ')[0]
 
-            data=[]
+        # cls_id = num_to_id_ESC50(int(cls_id))
+        cls_id = num_to_id_ESC10(cls_id)
 
+        audio_data = np.load(npyPaths[f], mmap_mode='r')
 
-def get_spec(pkl):
-    """
-    :return: [{'key', 'data', 'label'}, {}, {}... {}]
-    """
+        # make each audio exactly 5s, the tail stays zero-padded.
+        audio_data = audio_data[: wav_len]
 
-    win_size = 66150
-    stride = int(44100 * 0.2)
+        # audio_data = audio_data * 1.0 / np.max(abs(audio_data))
 
-    for fold_num in range(5):
-        trainPkl = '../data_wave_ESC10_44100/fold' + str(fold_num) + '_train.cPickle'
-        validPkl = '../data_wave_ESC10_44100/fold' + str(fold_num) + '_valid.cPickle'
-    sampleSet = load_data(pkl)
+        samples, scale = encode_clip(audio_data, data.dtype)
+        data[idx, :len(audio_data)] = samples
+        data[idx, len(audio_data):] = 0
 
-    segs = []
+        scales.append(scale)
+        labels.append(int(cls_id))
+        keys.append(f.split('/')[-1].split('.')[0])
 
-    for item in sampleSet:
-        print(item['label'], item['key'])
-        record_data = item['data']
+    close_store(storeDir, data, labels, keys, None if dtype == 'float32' else scales)
 
-        for j in range(0, len(record_data) - win_size + 1, stride):
+    rows = {f: idx for idx, f in enumerate(waveList)}
+    for fold_num, (trainWaveList, testWaveList) in enumerate(foldLists):
+        print('get indices on fold ', str(fold_num))
+        save_fold(storeDir, fold_num, 'train', [rows[f] for f in trainWaveList])
+        save_fold(storeDir, fold_num, 'test', [rows[f] for f in testWaveList])
 
-            seg = {}
-            win_data = record_data[j: j+win_size]
-            # Continue if cropped region is silent
 
-            maxamp = np.max(np.abs(win_data))
-            if maxamp < 0.005:
-                continue
-            melspec = librosa.feature.melspectrogram(win_data, 44100, n_fft=2048, hop_length=150, n_mels=64)  # (40, 442)
-            logmel = librosa.logamplitude(melspec)[:,:441]  # (40, 441)
-            delta = librosa.feature.delta(logmel)
+def get_spec(fs=44100, cache_dir='../cache_feat', win_size=None, stride=None, dtype='float32'):
+    """
+    fill the feature cache with the non-silent windows of every clip of the store.
 
-            feat = np.stack((logmel, delta))
+    all folds are index views over the same store, so each clip is done once.
+    LogMelDataset finds the features of its grid crops in the cache, see feature_cache.FeatureCache.
+    """
 
-            seg['label'] = item['label']
-            seg['key'] = item['key']
-            seg['data'] = feat
+    win_size = win_size or window_length(fs)
+    stride = stride or int(fs * 0.2)
+    store = load_store(store_dir(fs, dtype))
+    cache = FeatureCache(cache_dir, fs=fs, store_dtype=store['data'].dtype)
 
-            segs.append(seg)
+    start = time.time()
+    for clip in range(len(store['label'])):
+        record_data = store['data'][clip]
+        scale = store['scale'][clip]
+        wins = sliding_windows(record_data, win_size, stride)
+        # Continue if cropped region is silent
+        for j in np.flatnonzero(window_maxamp(record_data, win_size, stride) * scale >= 0.005):
+            cache.get(store['key'][clip], decode_window(wins[j], scale), j * stride)
 
-    # save_data('../segments_logmel/fold' + str(fold_num) + '_train.cPickle', segs)
-    save_data('../segments_logmel/fold0_valid.cPickle', segs)
-    print(segs)
-    print(len(segs))
+    print('feature cache: {} windows computed, {} already cached ({:.1f}s)'.format(
+        cache.misses, cache.hits, time.time() - start))
 
 
 if __name__ == '__main__':
 
-
-    get_pkl(fs=44100)
-    data = load_data('../data_wave_ESC10_44100/fold0_train.cPickle')
-    print("data num: ", len(data))
-    print(data[0])
-
-    # get_spec('../data_wave_44100/fold0_valid.cPickle')
+    parser = argparse.ArgumentParser(description='transfer audio into waveform stores')
+    parser.add_argument('--fs', type=int, default=44100, help='sample rate')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='number of processes decoding audio files')
+    parser.add_argument('--dtype', type=str, default='float32',
+                        help='float32, or int16 / float16 for a compact store in ../data_wave_ESC10_<fs>_<dtype>')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='also fill this feature cache, see get_spec')
+    args = parser.parse_args()
+
+    get_store(fs=args.fs, num_workers=args.num_workers, dtype=args.dtype)
+    store = load_store(store_dir(args.fs, args.dtype))
+    trainIndices = load_fold(store['dir'], 0, 'train')
+    print("data num: ", len(store['label']), "fold0 train num: ", len(trainIndices))
+    print(store['label'][trainIndices[0]], store['key'][trainIndices[0]], store['data'][trainIndices[0]])
+
+    if args.cache_dir is not None:
+        get_spec(fs=args.fs, cache_dir=args.cache_dir, dtype=args.dtype)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+export a trained model as an inference graph, with BatchNorm folded and dropout stripped.
+
+usage:
+    python export.py --model='../model/WaveMsNet_fold0_epoch160.pkl'
+    python export.py --model='...' --format=onnx
+
+network.fold_batchnorm folds every bnX into the convX before it, then the model is
+traced on one window and saved next to it as <model>_export.pt (TorchScript, loaded
+with util.load_model) or <model>_export.onnx. The outputs of the eager model, the
+folded model and the exported graph are compared, with their latency at batch size 1 and 32.
+
+"""
+import argparse
+import torch
+from network import *
+from util import *
+from quantize import latency
+
+
+def export(model, path, fmt='torchscript', win_size=66150):
+    """
+    :param model: float model, left unchanged.
+    :return: the folded model that was exported.
+    """
+    folded = fold_batchnorm(model)
+    x = torch.zeros(1, 1, win_size)
+    with torch.no_grad():
+        if fmt == 'onnx':
+            torch.onnx.export(folded, x, path, input_names=['wave'], output_names=['logits'],
+                              dynamic_axes={'wave': {0: 'batch'}, 'logits': {0: 'batch'}})
+        else:
+            torch.jit.save(torch.jit.trace(folded, x), path)
+    return folded
+
+
+def onnx_runner(path):
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(x):
+        return torch.from_numpy(session.run(None, {'wave': x.numpy()})[0])
+    return run
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='export a model with BatchNorm folded into the convolutions')
+    parser.add_argument('--model', type=str, required=True, help='trained model path')
+    parser.add_argument('--format', type=str, default='torchscript', help='torchscript or onnx')
+    parser.add_argument('--out', type=str, default=None, help='output path (default: next to --model)')
+    parser.add_argument('--fs', type=int, default=44100, help='sample rate the model was trained at')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    model = load_model(args.model)
+    out = args.out or args.model.rsplit('.', 1)[0] + ('_export.onnx' if args.format == 'onnx' else '_export.pt')
+    win_size = window_length(args.fs)
+    folded = export(model, out, args.format, win_size)
+    runner = onnx_runner(out) if args.format == 'onnx' else load_model(out)
+    print('saved ' + out)
+
+    x = 0.1 * torch.randn(32, 1, win_size)
+    with torch.no_grad():
+        ref = model(x)
+        print('max |eager - folded|:   {:.3g}'.format((folded(x) - ref).abs().max().item()))
+        print('max |eager - exported|: {:.3g}  (max |logit| {:.3g})'.format(
+            (runner(x) - ref).abs().max().item(), ref.abs().max().item()))
+
+    for batch_size in (1, 32):
+        print('batch {:2d}: eager {:.1f}ms  folded {:.1f}ms  exported {:.1f}ms'.format(
+            batch_size, latency(model, batch_size, win_size=win_size), latency(folded, batch_size, win_size=win_size),
+            latency(runner, batch_size, win_size=win_size)))
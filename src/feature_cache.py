@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+on-disk caches of the features of waveform windows: spectrogram features,
+and the frontend maps of a frozen model for phase-2 training.
+
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import torch
+import librosa
+from network import LogMel
+from util import window_maxamp, decode_window, frontend_hop, fft_size
+
+
+class FeatureCache(object):
+    """
+    log-mel, delta and MFCC features of a window, keyed by a hash of
+    (clip key, window start, window length, feature params). The params include the
+    dtype of the store, as int16/float16 windows differ slightly from float32 ones.
+
+    each entry is one (96 + 96 + 32, frames) float32 .npy file under
+    cache_dir/<hash[:2]>/<hash>.npy, loaded memory-mapped. Entries are computed on
+    the first get() and written atomically, so DataLoader workers and concurrent runs
+    can fill the same cache. Changing a feature param changes every hash, old entries
+    are never reused and age out of the cache.
+
+    the size of the cache is capped at max_bytes: the least recently used entries
+    (by mtime, touched on every hit) are evicted.
+    """
+    def __init__(self, cache_dir, fs=44100, n_fft=None, hop_length=None, n_mels=96, n_mfcc=32,
+                 max_bytes=8 * 2**30, store_dtype='float32'):
+        """
+        :param store_dtype: dtype of the store the windows are read from, str(store['data'].dtype)
+        :param n_fft: default util.fft_size(fs), 2048 at 44.1kHz
+        :param hop_length: default util.frontend_hop(fs), 150 at 44.1kHz
+        """
+        n_fft = n_fft or fft_size(fs)
+        hop_length = hop_length or frontend_hop(fs)
+        self.cache_dir = cache_dir
+        self.params = {'fs': fs, 'n_fft': n_fft, 'hop_length': hop_length, 'n_mels': n_mels, 'n_mfcc': n_mfcc,
+                       'store_dtype': str(np.dtype(store_dtype))}
+        self.params_json = json.dumps(self.params, sort_keys=True)
+        self.max_bytes = max_bytes
+        # rows of each feature in an entry
+        self.layout = {'logmel': (0, n_mels), 'delta': (n_mels, 2 * n_mels),
+                       'mfcc': (2 * n_mels, 2 * n_mels + n_mfcc)}
+        self.logmel = LogMel(fs, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels)
+
+        self.hits = 0
+        self.misses = 0
+        self.size = None  # bytes in the cache, scanned on the first write
+        self.written = 0  # bytes written since the last scan
+
+    def path(self, clip_key, start, win_size):
+        h = hashlib.sha1('{}|{}|{}|{}'.format(clip_key, int(start), int(win_size),
+                                              self.params_json).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, h[:2], h + '.npy')
+
+    def get(self, clip_key, win, start):
+        """
+        :param clip_key: key of the clip, store['key'][clip]
+        :param win: the 1-D window, only read on a miss; its length is part of the key.
+        :param start: first sample of the window in the clip.
+        :return: {'logmel': (n_mels, frames), 'delta': (n_mels, frames), 'mfcc': (n_mfcc, frames)}
+                 read-only memory-mapped views.
+        """
+        path = self.path(clip_key, start, len(win))
+        try:
+            entry = np.load(path, mmap_mode='r')
+            os.utime(path, None)  # most recently used
+            self.hits += 1
+        except (IOError, OSError, ValueError):
+            # missing, or evicted or half written by another process
+            entry = self.compute(win)
+            self.put(path, entry)
+            self.misses += 1
+        return dict((name, entry[a: b]) for name, (a, b) in self.layout.items())
+
+    def compute(self, win):
+        win = np.ascontiguousarray(win, dtype=np.float32)
+        with torch.no_grad():
+            logmel = self.logmel(torch.from_numpy(win).view(1, -1))[0, 0].numpy()  # (96, 441)
+        frames = logmel.shape[1]
+        delta = librosa.feature.delta(logmel)
+        mfcc = librosa.feature.mfcc(y=win, sr=self.params['fs'], n_fft=self.params['n_fft'],
+                                    hop_length=self.params['hop_length'], n_mfcc=self.params['n_mfcc'])[:, :frames]
+        return np.concatenate((logmel, delta, mfcc)).astype(np.float32)
+
+    def put(self, path, entry):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmpPath, 'wb') as fp:
+            np.save(fp, entry)
+        os.replace(tmpPath, path)
+
+        self.written += os.path.getsize(path)
+        if self.size is None or self.written > 0.05 * self.max_bytes:
+            # rescan now and then, other processes fill the cache too
+            self.size = self.scan()[1]
+            self.written = 0
+        if self.size + self.written > self.max_bytes:
+            self.evict()
+
+    def scan(self):
+        """
+        :return: [(mtime, size, path)] of all entries, total size in bytes.
+        """
+        entries = []
+        if os.path.exists(self.cache_dir):
+            for shard in os.listdir(self.cache_dir):
+                shardDir = os.path.join(self.cache_dir, shard)
+                if not os.path.isdir(shardDir):
+                    continue
+                for name in os.listdir(shardDir):
+                    if not name.endswith('.npy'):
+                        continue
+                    try:
+                        st = os.stat(os.path.join(shardDir, name))
+                    except OSError:
+                        continue  # evicted meanwhile
+                    entries.append((st.st_mtime, st.st_size, os.path.join(shardDir, name)))
+        return entries, sum(e[1] for e in entries)
+
+    def evict(self):
+        """
+        drop the least recently used entries until the cache is 10% below max_bytes.
+        other processes writing the cache are accounted for by rescanning it.
+        """
+        entries, size = self.scan()
+        entries.sort()
+        target = 0.9 * self.max_bytes
+        for mtime, nbytes, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)  # processes that already mapped it keep their view
+            except OSError:
+                pass
+            size -= nbytes
+        self.size = size
+        self.written = 0
+
+
+class FrontendCache(object):
+    """
+    pooled (96, 441) frontend maps of a frozen model, for phase-2 training of the backend.
+
+    the frontend is evaluated once over the non-silent crops of each clip on a grid of
+    `stride` samples (the crops of data_transform.get_spec and of main.test), and the maps
+    are kept in cache_dir/frontend_<hash>/maps.npy, memory-mapped. crops.npy holds the
+    (clip, start) of each row. The hash covers the frontend weights and running stats, the
+    keys, rows and scales of the clips, the store dtype and the grid, so a retrained
+    frontend or a rewritten store gets a new cache.
+    """
+    def __init__(self, cache_dir, model, store, clips, win_size=66150, stride=8820, batch_size=32, cuda=False):
+        """
+        :param model: model with frontend(), its conv1_x, bn1_x, conv2_x and bn2_x are hashed.
+        :param store: store dict from util.load_store
+        :param clips: rows of the store, e.g. the indices of a fold split.
+        """
+        self.win_size = win_size
+        self.stride = stride
+
+        sha = hashlib.sha1('{}|{}|{}'.format(win_size, stride, store['data'].dtype).encode('utf-8'))
+        # clip keys and scales rather than row numbers: a rewritten or compact store gets its own cache
+        sha.update('\n'.join(store['key'][clip] for clip in clips).encode('utf-8'))
+        sha.update(np.ascontiguousarray(np.asarray(store['scale'])[clips], dtype=np.float32).tobytes())
+        sha.update(np.ascontiguousarray(clips, dtype=np.int64).tobytes())
+        for name, value in sorted(model.state_dict().items()):
+            if name.split('.')[0].split('_')[0] in ('conv1', 'bn1', 'conv2', 'bn2'):
+                sha.update(name.encode('utf-8'))
+                sha.update(value.cpu().numpy().tobytes())
+        self.dir = os.path.join(cache_dir, 'frontend_' + sha.hexdigest()[:16])
+
+        if not os.path.exists(os.path.join(self.dir, 'crops.npy')):
+            self.build(model, store, clips, batch_size, cuda)
+        self.maps = np.load(os.path.join(self.dir, 'maps.npy'), mmap_mode='r')
+        self.crops = np.load(os.path.join(self.dir, 'crops.npy'))
+
+        # position in clips of the clip of each row, and the rows of each clip
+        pos = dict((clip, p) for p, clip in enumerate(clips))
+        self.pos = np.array([pos[clip] for clip in self.crops[:, 0]], dtype=np.int64)
+        self.rows = [[] for _ in clips]
+        for row, p in enumerate(self.pos):
+            self.rows[p].append(row)
+
+    def build(self, model, store, clips, batch_size, cuda):
+        crops = []
+        for clip in clips:
+            maxamp = window_maxamp(store['data'][clip], self.win_size, self.stride) * store['scale'][clip]
+            keep = np.flatnonzero(maxamp >= 0.005)
+            for j in (keep if len(keep) else [0]):
+                crops.append((clip, j * self.stride))
+        crops = np.array(crops, dtype=np.int64)
+
+        tmpDir = '{}.{}.tmp'.format(self.dir, os.getpid())
+        os.makedirs(tmpDir)
+        maps = None
+        buf = np.empty((batch_size, 1, self.win_size), dtype=np.float32)
+        out = None  # frontend output, reused by every full batch
+
+        was_training = model.training
+        model.eval()
+        start = time.time()
+        with torch.no_grad():
+            for b in range(0, len(crops), batch_size):
+                n = min(batch_size, len(crops) - b)
+                for i, (clip, s) in enumerate(crops[b: b+n]):
+                    decode_window(store['data'][clip][s: s + self.win_size], store['scale'][clip], out=buf[i, 0])
+                x = torch.from_numpy(buf[:n])
+                if cuda:
+                    x = x.cuda()
+                out = model.frontend(x, out=out)
+                h = out[:, 0].cpu().numpy()  # (n, 96L, 441L)
+                if maps is None:
+                    maps = np.lib.format.open_memmap(os.path.join(tmpDir, 'maps.npy'), mode='w+', dtype=np.float32,
+                                                    shape=(len(crops),) + h.shape[1:])
+                maps[b: b+n] = h
+        model.train(was_training)
+
+        maps.flush()
+        del maps
+        np.save(os.path.join(tmpDir, 'crops.npy'), crops)
+        try:
+            os.rename(tmpDir, self.dir)
+        except OSError:
+            shutil.rmtree(tmpDir)  # built meanwhile by another process
+        print('frontend cache: {} crops of {} clips in {:.1f}s'.format(len(crops), len(clips), time.time() - start))
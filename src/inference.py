@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+batched sliding-window inference on waveform stores.
+
+"""
+import numpy as np
+import torch
+from util import *
+
+
+def window_batches(data, clips, win_size, stride, batch_size, threshold=0.005, scale=None):
+    """
+    pack the non-silent windows of many clips into fixed-size batches.
+
+    :param data: (num_clips, num_samples) waveforms, e.g. store['data']
+    :param clips: rows of data to evaluate
+    :param threshold: windows with a peak amplitude below it are skipped as silent.
+    :param scale: store['scale'], the windows of int16/float16 stores are converted as they are batched.
+    :return: yields (wins, pos). wins is a (n, 1L, win_size) FloatTensor and pos a LongTensor
+             with the position in clips of the clip each window comes from. n == batch_size
+             except for the last batch. Both reuse one buffer: consume them before the next batch.
+    """
+    buf = np.empty((batch_size, 1, win_size), dtype=np.float32)
+    pos = np.empty(batch_size, dtype=np.int64)
+    n = 0
+
+    for p, clip in enumerate(clips):
+        record_data = data[clip]
+        s = 1. if scale is None else scale[clip]
+        wins = sliding_windows(record_data, win_size, stride)
+        keep = np.flatnonzero(window_maxamp(record_data, win_size, stride) * s >= threshold)
+
+        k = 0
+        while k < len(keep):
+            m = min(batch_size - n, len(keep) - k)
+            if record_data.dtype == np.float32 and s == 1:
+                np.take(wins, keep[k: k+m], axis=0, out=buf[n: n+m, 0])
+            else:
+                decode_window(wins[keep[k: k+m]], s, out=buf[n: n+m, 0])
+            pos[n: n+m] = p
+            n += m
+            k += m
+            if n == batch_size:
+                yield torch.from_numpy(buf), torch.from_numpy(pos)
+                n = 0
+
+    if n > 0:
+        yield torch.from_numpy(buf[:n]), torch.from_numpy(pos[:n])
+
+
+def window_scores(model, data, clips, win_size, stride, batch_size, threshold=0.005, scale=None, cuda=False):
+    """
+    sum of the logits of the non-silent windows of each clip, one forward per window.
+
+    :return: scores (len(clips), num_classes) FloatTensor, num_wins windows evaluated per clip.
+    """
+    scores = None
+    num_wins = np.zeros(len(clips), dtype=np.int64)
+
+    with torch.no_grad():
+        for wins, pos in window_batches(data, clips, win_size, stride, batch_size, threshold, scale):
+            num_wins += np.bincount(pos.numpy(), minlength=len(clips))
+            if cuda:
+                wins, pos = wins.cuda(), pos.cuda()
+
+            output = model(wins)  # (N, 50L)
+            if scores is None:
+                scores = output.new_zeros(len(clips), output.size(1))
+            scores.index_add_(0, pos, output)
+
+    return scores, num_wins
+
+
+def supports_clip_inference(model):
+    """
+    clip_scores needs a waveform frontend() and backend() pair: WaveMsNet and the phase-1
+    *_fixed_logmel models. nn.Sequential(LogMel(), WaveMsNet_Logmel()) has none, and phase-2
+    models also need the log-mel features of each window.
+    """
+    return hasattr(model, 'frontend') and hasattr(model, 'backend') and hasattr(model, 'hop') and \
+        getattr(model, 'phase', 1) == 1
+
+
+def backend_input(model, h):
+    """
+    :param h: (N, 1L, 96L, 441L) frontend crops
+    :return: the backend input built from them as in model.forward: phase-1 *_fixed_logmel
+             models take the maps twice, (N, 2L, 96L, 441L).
+    """
+    if getattr(model, 'phase', None) == 1:
+        return torch.cat((h, h), dim=1)
+    return h
+
+
+def frontend_crops(model, x, win_size, stride_frames):
+    """
+    run the frontend once over long inputs and crop its output into windows.
+
+    :param x: (G, 1L, L) waveforms
+    :return: (G * num_crops, 1L, 96L, win_size // model.hop) crops, clip by clip,
+             crop j of a clip starts at sample j * stride_frames * model.hop.
+    """
+    frames = win_size // model.hop
+    h = model.frontend(x)  # (G, 1L, 96L, T)
+    crops = h.unfold(3, frames, stride_frames)  # (G, 1L, 96L, num_crops, 441L)
+    return crops.permute(0, 3, 1, 2, 4).contiguous().view(-1, 1, h.size(2), frames)
+
+
+def clip_scores(model, data, clips, win_size, stride, batch_size, threshold=0.005, scale=None, cuda=False):
+    """
+    same as window_scores, but the frontend of the model runs once over each whole clip
+    and its (96L, T) output is cropped into the windows the backend expects.
+
+    the window stride is rounded to a multiple of model.hop so crops fall on frame
+    boundaries. Scores differ from window_scores only at the zero padding of window edges.
+    """
+    if not supports_clip_inference(model):
+        raise ValueError('clip inference needs a model with a waveform frontend and backend, '
+                         'e.g. WaveMsNet or a phase-1 *_fixed_logmel model')
+    hop = model.hop
+    frames = win_size // hop
+    stride_frames = max(1, int(round(stride / float(hop))))
+    num_crops = (data.shape[1] // hop - frames) // stride_frames + 1
+    # whole clips per frontend call, about batch_size crops come out of it
+    group = max(1, batch_size // num_crops)
+
+    scores = None
+    num_wins = np.zeros(len(clips), dtype=np.int64)
+
+    with torch.no_grad():
+        for g in range(0, len(clips), group):
+            rows = clips[g: g+group]
+            x = np.asarray(data[rows], dtype=np.float32)
+            if scale is not None:
+                x *= scale[rows][:, np.newaxis]
+            x = torch.from_numpy(x).unsqueeze(1)  # (G, 1L, 220500L)
+
+            keep = []
+            for p, clip in enumerate(rows):
+                maxamp = window_maxamp(data[clip], win_size, stride_frames * hop)[:num_crops]
+                if scale is not None:
+                    maxamp = maxamp * scale[clip]
+                keep.append(p * num_crops + np.flatnonzero(maxamp >= threshold))
+            keep = np.concatenate(keep)
+            num_wins[g: g+len(rows)] += np.bincount(keep // num_crops, minlength=len(rows))
+            if len(keep) == 0:
+                continue
+
+            if cuda:
+                x = x.cuda()
+            crops = frontend_crops(model, x, win_size, stride_frames)
+
+            keep = torch.from_numpy(keep)
+            pos = keep // num_crops + g
+            if cuda:
+                keep, pos = keep.cuda(), pos.cuda()
+
+            for b in range(0, len(keep), batch_size):
+                output = model.backend(backend_input(model, crops[keep[b: b+batch_size]]))  # (N, 50L)
+                if scores is None:
+                    scores = output.new_zeros(len(clips), output.size(1))
+                scores.index_add_(0, pos[b: b+batch_size], output)
+
+    return scores, num_wins
+
+
+if __name__ == '__main__':
+
+    # check clip_scores against window_scores on random clips with untrained models:
+    #     python inference.py --fs=16000
+    import argparse
+    import network
+
+    parser = argparse.ArgumentParser(description='compare clip_scores with window_scores')
+    parser.add_argument('--networks', type=str, default='WaveMsNet,WaveMsNet_fixed_logmel')
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--num_clips', type=int, default=4)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    win_size = window_length(args.fs)
+    hop = frontend_hop(args.fs)
+    data = (0.1 * np.random.RandomState(0).randn(args.num_clips, 5 * args.fs)).astype(np.float32)
+    clips = np.arange(args.num_clips)
+    # a stride on frame boundaries, so both evaluate the same windows
+    stride = int(round(0.2 * args.fs / hop)) * hop
+
+    for name in args.networks.split(','):
+        model = getattr(network, name)(fs=args.fs).eval()
+        windows, num_windows = window_scores(model, data, clips, win_size, stride, 16)
+        crops, num_crops = clip_scores(model, data, clips, win_size, stride, 16)
+        assert (num_windows == num_crops).all(), 'clip_scores and window_scores evaluated different windows'
+        diff = ((crops - windows).abs().max() / windows.abs().max()).item()
+        # the crops only differ at the zero padding of the window edges
+        print('{}: max |clip - window| / max |window| = {:.2e}, same argmax on {}/{} clips'.format(
+            name, diff, (crops.argmax(1) == windows.argmax(1)).sum().item(), args.num_clips))
+        assert diff < 1e-2, 'clip_scores differs from window_scores'
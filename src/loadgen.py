@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+load generator for server.py.
+
+usage:
+    python loadgen.py --port=8000 --concurrency=16 --requests=2000
+    python loadgen.py --unix=/tmp/wavemsnet.sock --source='audio.ogg'
+
+"""
+import argparse
+import http.client
+import socket
+import threading
+import time
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(args):
+    if args.unix:
+        return UnixHTTPConnection(args.unix)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def client(args, body, content_type, counter, latency, errors, lock):
+    conn = connect(args)
+    while True:
+        with lock:
+            if counter[0] >= args.requests:
+                break
+            counter[0] += 1
+        start = time.time()
+        try:
+            conn.request('POST', '/predict', body, {'Content-Type': content_type})
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            conn = connect(args)
+            ok = False
+        with lock:
+            if ok:
+                latency.append(time.time() - start)
+            else:
+                errors[0] += 1
+    conn.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='load generator for server.py')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', type=str, help='unix socket of the server')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients sending requests in parallel')
+    parser.add_argument('--requests', type=int, default=1000, help='total number of requests')
+    parser.add_argument('--source', type=str, help='audio file sent as request body (default: random window)')
+    parser.add_argument('--seconds', type=float, default=1.5, help='length of random requests')
+    parser.add_argument('--fs', type=int, default=44100)
+    args = parser.parse_args()
+
+    if args.source:
+        body = open(args.source, 'rb').read()
+        content_type = 'audio/' + args.source.split('.')[-1]
+    else:
+        wave = 0.1 * np.random.randn(int(args.seconds * args.fs))
+        body = wave.astype('<f4').tobytes()
+        content_type = 'application/octet-stream'
+
+    counter, errors, latency = [0], [0], []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=client, args=(args, body, content_type, counter, latency, errors, lock))
+               for _ in range(args.concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapse = time.time() - start
+
+    print('requests: {}  errors: {}  concurrency: {}  ({:.1f}s)'.format(
+        len(latency), errors[0], args.concurrency, elapse))
+    print('throughput: {:.1f} requests/s'.format(len(latency) / elapse))
+    if latency:
+        print('client latency: p50 {:.1f}ms  p99 {:.1f}ms'.format(
+            1000 * np.percentile(latency, 50), 1000 * np.percentile(latency, 99)))
+
+    conn = connect(args)
+    conn.request('GET', '/stats')
+    print('server stats: ' + conn.getresponse().read().decode('utf-8'))
+    conn.close()
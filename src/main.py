@@ -1,12 +1,17 @@
 """ usage:
     python main.py
-    python main.py --network=WaveMsNet --mode=test --model='../model/dnn_mix.pkl'
+    python main.py --network=WaveMsNet --mode=test --fold=0 --model='../model/dnn_mix.pkl'
 
 """
 import argparse
+import json
 import time
 from network import *
 from data_process import *
+from inference import *
+from feature_cache import *
+from augment import *
+from profiler import LayerProfiler
 import os
 
 # Training settings
@@ -34,15 +39,52 @@ parser.add_argument('--log-interval', type=int, default=20, metavar='N',
 parser.add_argument('--model_save_interval', type=int, default=40, metavar='N',
                             help='how many epochs to wait before saving the model.')
 parser.add_argument('--network', type=str, help='WaveMsNet or WaveMsNet_Logmel')
+parser.add_argument('--milestones', type=str, default='60,120,140',
+                            help='comma separated epochs at which the learning rate is divided by 10')
+parser.add_argument('--val_interval', type=int, default=40, metavar='N',
+                            help='how many epochs to wait before testing and saving the best model')
+parser.add_argument('--target_acc', type=float, default=None,
+                            help='stop training a fold once its TestACC reaches this percentage')
+parser.add_argument('--curve', type=str, default=None,
+                            help='append one JSON line per test (fold, epoch, train time, samples, TestACC) to this file')
 parser.add_argument('--mode', type=str, default='train',
                             help='train or test')
+parser.add_argument('--fold', type=int, default=None,
+                            help='only run this fold (default: all five folds)')
 parser.add_argument('--model', type=str, default='../model/WaveMsNet_fold0_v2_epoch120.pkl',
                             help='trained model path')
 parser.add_argument('--train_slices', type=int, default=1,
                             help='slices number of one record divide into.')
+parser.add_argument('--crops_per_sample', type=int, default=1,
+                            help='random crops drawn from each clip per training sample')
 parser.add_argument('--test_slices_interval', type=int, default=0.2,
                             help='slices number of one record divide into.')
-parser.add_argument('--fs', type=int)
+parser.add_argument('--fs', type=int, default=44100,
+                            help='sample rate, the store is ../data_wave_<fs> and the networks are built for it')
+parser.add_argument('--store_dtype', type=str, default='float32',
+                            help='int16 or float16: train on the compact store ../data_wave_<fs>_<dtype>')
+parser.add_argument('--num_threads', type=int, default=None,
+                            help='torch intra-op threads (default: torch decides)')
+parser.add_argument('--num_workers', type=int, default=2,
+                            help='DataLoader worker processes')
+parser.add_argument('--prefetch', type=int, default=2,
+                            help='batches assembled ahead of the train step in a background thread, 0: plain DataLoader')
+parser.add_argument('--shared_memory', action='store_true', default=False,
+                            help='load the waveforms into one shared memory tensor instead of memory-mapping them')
+parser.add_argument('--checkpoint_frontend', action='store_true', default=False,
+                            help='recompute the frontend in the backward pass, for larger batches in the same memory')
+parser.add_argument('--augment', type=str, default='',
+                            help='comma separated batch augmentations: ' + ','.join(AUGMENTATIONS))
+parser.add_argument('--mixup_alpha', type=float, default=0.2,
+                            help='Beta(alpha, alpha) weight of --augment=mixup')
+parser.add_argument('--profile', type=str, default=None,
+                            help='per-layer profile of every epoch, written to <profile>_fold<n>.json and .trace.json')
+parser.add_argument('--phase', type=int, default=1,
+                            help='2: train the backend of a phase-1 *_fixed_logmel --model on cached frontend maps')
+parser.add_argument('--cache_dir', type=str, default='../cache_feat',
+                            help='feature and frontend map caches')
+parser.add_argument('--clip_inference', action='store_true', default=False,
+                            help='run the frontend once per test clip and crop its output into windows')
 
 
 os.environ['CUDA_VISIBLE_DEVICES'] = "1"
@@ -50,27 +92,43 @@ os.environ['CUDA_VISIBLE_DEVICES'] = "1"
 args = parser.parse_args()
 args.cuda = not args.no_cuda and torch.cuda.is_available()
 
+if args.num_threads is not None:
+    torch.set_num_threads(args.num_threads)
+
 #  torch.manual_seed(args.seed)
 if args.cuda:
     torch.cuda.manual_seed(args.seed)
     #  torch.cuda.set_device(2)
 
-def train(model, optimizer, train_loader, epoch):
+def train(model, optimizer, train_loader, epoch, augment=None, profiler=None):
 #{{{
     model.train()
     start = time.time()
 
     running_loss = 0
     running_correct = 0
+    num_samples = 0
+
+    loader = train_loader if profiler is None else profiler.loader(train_loader)
+    for idx, (data, label) in enumerate(loader):
 
-    for idx, (data, label) in enumerate(train_loader):
+        if data.dim() == 4:
+            # (batch, crops, 1, window) from --crops_per_sample, every crop keeps its clip label
+            label = label.view(-1, 1).expand(data.size(0), data.size(1))
+            data = data.view(-1, 1, data.size(3))
 
         #  reshape to torch.LongTensor of size 64
-        label = label.resize_(label.size()[0])
+        label = label.reshape(-1)
+        num_samples += label.numel()
 
-        if args.cuda:
+        # BatchPrefetcher batches are already on the gpu
+        if args.cuda and not data.is_cuda:
             data, label = data.cuda(), label.cuda()
-        data, label = Variable(data), Variable(label)
+
+        # on the whole batch, on the gpu with --cuda
+        mix = None
+        if augment is not None:
+            data, label, mix = augment(data, label)
 
         optimizer.zero_grad()
 
@@ -79,149 +137,325 @@ def train(model, optimizer, train_loader, epoch):
         # print(label)
         # print output.size()
         # exit(0)
-        loss = F.cross_entropy(output, label)
+        loss = mixed_cross_entropy(output, label, mix)
         #  loss = F.nll_loss(output, label)
 
         loss.backward()
+        if profiler is not None:
+            profiler.step()
 
         optimizer.step()
         _, pred = torch.max(output.data, 1)  # get the index of the max log-probability
 
         # statistics
-        running_loss += loss.data[0]
-        running_correct += torch.sum(pred == label.data.view_as(pred))
+        running_loss += loss.item()
+        running_correct += (pred == label.view_as(pred)).sum().item()
 
     epoch_loss = running_loss / len(train_loader)
-    epoch_acc = 100.0 * running_correct / len(train_loader.dataset)
+    epoch_acc = 100.0 * running_correct / num_samples
 
     elapse = time.time() - start
 
-    print('Epoch:{} ({:.1f}s) lr:{:.4g}  '
+    print('Epoch:{} ({:.1f}s{}) lr:{:.4g}  '
           'samples:{}  Loss:{:.3f}  TrainAcc:{:.2f}%'.format(
-        epoch, elapse, optimizer.param_groups[0]['lr'],
-        len(train_loader.dataset), epoch_loss, epoch_acc))
+        epoch, elapse, loader_wait(train_loader), optimizer.param_groups[0]['lr'],
+        num_samples, epoch_loss, epoch_acc))
+
+    return num_samples
 
 
+def loader_wait(train_loader):
+    """
+    time the epoch waited for batches, reported by BatchPrefetcher.
+    """
+    if isinstance(train_loader, BatchPrefetcher):
+        return ', waited {:.1f}s for data'.format(train_loader.wait)
+    return ''
 
-def test(model, test_pkl):
+
+def train_phase2(model, optimizer, train_loader, epoch, profiler=None):
+#{{{
+    model.train()
+    start = time.time()
+
+    running_loss = 0
+    running_correct = 0
+    num_samples = 0
+
+    # the frontend is frozen, its cached maps are fused with the log-mel features
+    loader = train_loader if profiler is None else profiler.loader(train_loader)
+    for idx, (h, feat, label) in enumerate(loader):
+
+        label = label.reshape(-1)
+        num_samples += label.numel()
+
+        if args.cuda and not h.is_cuda:
+            h, feat, label = h.cuda(), feat.cuda(), label.cuda()
+
+        optimizer.zero_grad()
+        output = model.backend(torch.cat((h, feat), dim=1))  # (batch, 10L)
+        loss = F.cross_entropy(output, label)
+        loss.backward()
+        if profiler is not None:
+            profiler.step()
+        optimizer.step()
+        _, pred = torch.max(output.data, 1)
+
+        # statistics
+        running_loss += loss.item()
+        running_correct += (pred == label).sum().item()
+
+    epoch_loss = running_loss / len(train_loader)
+    epoch_acc = 100.0 * running_correct / num_samples
+
+    elapse = time.time() - start
+
+    print('Epoch:{} ({:.1f}s{}) lr:{:.4g}  '
+          'samples:{}  Loss:{:.3f}  TrainAcc:{:.2f}%'.format(
+        epoch, elapse, loader_wait(train_loader), optimizer.param_groups[0]['lr'],
+        num_samples, epoch_loss, epoch_acc))
+
+    return num_samples
+
+
+def test_phase2(model, testDataset):
 #{{{
     model.eval()
 
     start = time.time()
 
-    test_loss = 0
-    correct = 0
-    y_pred = []
-    y_true = []
+    cache = testDataset.frontend_cache
+    num_clips = len(testDataset.indices)
+    scores = None
+
+    # logits of all cached crops are summed per clip, as test()
+    with torch.no_grad():
+        for b in range(0, len(cache.crops), args.test_batch_size):
+            crops = [testDataset.crop(row) for row in range(b, min(b + args.test_batch_size, len(cache.crops)))]
+            h = torch.from_numpy(np.stack([c['wave'] for c in crops]))
+            feat = torch.from_numpy(np.stack([c['feat'] for c in crops]))
+            pos = torch.from_numpy(cache.pos[b: b + len(crops)])
+            if args.cuda:
+                h, feat, pos = h.cuda(), feat.cuda(), pos.cuda()
+            output = model.backend(torch.cat((h, feat), dim=1))
+            if scores is None:
+                scores = output.new_zeros(num_clips, output.size(1))
+            scores.index_add_(0, pos, output)
+
+    label = torch.from_numpy(testDataset.store['label'][testDataset.indices])
+    if args.cuda:
+        label = label.cuda()
 
-    win_size = 66150
-    stride = int(44100 * args.test_slices_interval)
-    sampleSet = load_data(test_pkl)
+    test_loss = F.cross_entropy(scores, label).item()  # mean over clips
+    pred = scores.max(1, keepdim=True)[1]
+    correct = pred.eq(label.view_as(pred)).sum().item()
 
-    for item in sampleSet:
-        label = item['label']
-        record_data = item['data']
-        wins_data = []
-        for j in range(0, len(record_data) - win_size + 1, stride):
+    test_acc = 100. * correct / num_clips
 
-            win_data = record_data[j: j+win_size]
-            # Continue if cropped region is silent
+    elapse = time.time() - start
+
+    print('\nTest set: Average loss: {:.3f} ({:.1f}s), TestACC: {}/{} {:.2f}%\n'.format(
+        test_loss, elapse, correct, num_clips, test_acc))
 
-            maxamp = np.max(np.abs(win_data))
-            if maxamp < 0.005:
-                continue
-            wins_data.append(win_data)
+    return test_acc
 
-        if len(wins_data) == 0:
-            print(item['key'])
 
-        wins_data = np.array(wins_data)
+def test(model, store, fold_num):
+#{{{
+    model.eval()
 
-        wins_data = wins_data[:, np.newaxis, :]
-        # print wins_data.shape
+    start = time.time()
 
-        data = torch.from_numpy(wins_data).type(torch.FloatTensor) # (N, 1L, 24002L)
-        label = torch.LongTensor([label])
+    win_size = window_length(args.fs)
+    stride = int(args.fs * args.test_slices_interval)
+    store, indices = open_fold(store, fold_num, 'test')
+    num_clips = len(indices)
 
-        if args.cuda:
-            data, label = data.cuda(), label.cuda()
-        data, label = Variable(data, volatile=True), Variable(label)
+    # windows of many clips share a batch, their logits are summed per clip.
+    if args.clip_inference:
+        scores, num_wins = clip_scores(model, store['data'], indices, win_size, stride,
+                                       args.test_batch_size, scale=store['scale'], cuda=args.cuda)
+    else:
+        scores, num_wins = window_scores(model, store['data'], indices, win_size, stride,
+                                         args.test_batch_size, scale=store['scale'], cuda=args.cuda)
 
-        # print data.size()
-        output = model(data)
-        output = torch.sum(output, dim=0, keepdim=True)
-        # print output
+    # clips without any non-silent window
+    for i in np.flatnonzero(num_wins == 0):
+        print(store['key'][indices[i]])
 
-        test_loss += F.cross_entropy(output, label).data[0] # sum up batch loss
-        pred = output.data.max(1, keepdim=True)[1]  # get the index of the max log-probability
-        correct += pred.eq(label.data.view_as(pred)).sum()
+    label = torch.from_numpy(store['label'][indices])
+    if args.cuda:
+        label = label.cuda()
+
+    test_loss = F.cross_entropy(scores, label).item()  # mean over clips
+    pred = scores.max(1, keepdim=True)[1]  # get the index of the max log-probability
+    correct = pred.eq(label.view_as(pred)).sum().item()
 
-    test_loss /= len(sampleSet)
-    test_acc = 100. * correct / len(sampleSet)
+    test_acc = 100. * correct / num_clips
 
     elapse = time.time() - start
 
     print('\nTest set: Average loss: {:.3f} ({:.1f}s), TestACC: {}/{} {:.2f}%\n'.format(
-        test_loss, elapse, correct, len(sampleSet), test_acc))
+        test_loss, elapse, correct, num_clips, test_acc))
 
     return test_acc
 
 
-def main_on_fold(foldNum, trainPkl, validPkl):
+def check_clip_inference(model):
+    if args.clip_inference and not supports_clip_inference(model):
+        parser.error('--clip_inference needs a waveform frontend and backend: WaveMsNet or a phase-1 '
+                     '*_fixed_logmel model, not ' + type(model).__name__)
+
+
+def main_on_fold(foldNum, store):
 
     if args.network == 'WaveMsNet':
-        model = WaveMsNet()
-    elif args.network == 'WaveMsNet_LogMel':
-        model = WaveMsNet_LogMel()
+        model = WaveMsNet(args.fs)
+    elif args.network in ('WaveMsNet_Logmel', 'WaveMsNet_LogMel'):
+        # log-mel features are computed on the collated batch, on the gpu with --cuda
+        model = nn.Sequential(LogMel(args.fs), WaveMsNet_Logmel(args.fs))
     elif args.network == 'WaveMsNet_srf_fixed_logmel':
-        model = WaveMsNet_srf_fixed_logmel()
+        model = WaveMsNet_srf_fixed_logmel(fs=args.fs)
     elif args.network == 'WaveMsNet_mrf_fixed_logmel':
-        model = WaveMsNet_mrf_fixed_logmel()
+        model = WaveMsNet_mrf_fixed_logmel(fs=args.fs)
     elif args.network == 'WaveMsNet_lrf_fixed_logmel':
-        model = WaveMsNet_lrf_fixed_logmel()
+        model = WaveMsNet_lrf_fixed_logmel(fs=args.fs)
     elif args.network == 'WaveMsNet_fixed_logmel':
-        model = WaveMsNet_fixed_logmel()
+        model = WaveMsNet_fixed_logmel(fs=args.fs)
+
+
+    if args.phase == 2:
+        # phase-1 model of this fold, e.g. --model='../model/WaveMsNet_fixed_logmel_fold{}_epoch160.pkl'
+        model = torch.load(args.model.format(foldNum))
+        model.changePhase(2)
+        for name, p in frontend_parameters(model):
+            p.requires_grad = False
+
+    if args.phase != 2:
+        check_clip_inference(model)
 
+    # see network.multiscale_frontend
+    model.checkpoint_frontend = args.checkpoint_frontend
 
     if args.cuda:
         model.cuda()
 
-    optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
     #  optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum)
-    exp_lr_scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[60, 120, 140], gamma=0.1)
-
-    trainDataset = WaveformDataset(trainPkl, window_size=66150, train_slices=args.train_slices, transform=ToTensor())
-
-    train_loader = DataLoader(trainDataset, batch_size=args.batch_size, shuffle=True, num_workers=2)
+    milestones = [int(m) for m in args.milestones.split(',') if m]
+    exp_lr_scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=milestones, gamma=0.1)
+
+    if args.phase == 2:
+        # the frozen frontend runs once over the test grid of each clip, see feature_cache.FrontendCache
+        stride = int(args.fs * args.test_slices_interval)
+        featureCache = FeatureCache(args.cache_dir, fs=args.fs, store_dtype=store['data'].dtype)
+        trainIndices = open_fold(store, foldNum, 'train')[1]
+        testIndices = open_fold(store, foldNum, 'test')[1]
+        trainDataset = FrontendCacheDataset(
+            FrontendCache(args.cache_dir, model, store, trainIndices, win_size=model.win_size, stride=stride,
+                          batch_size=args.test_batch_size, cuda=args.cuda),
+            featureCache, store, trainIndices, train_slices=args.train_slices, transform=ToTensor2())
+        testDataset = FrontendCacheDataset(
+            FrontendCache(args.cache_dir, model, store, testIndices, win_size=model.win_size, stride=stride,
+                          batch_size=args.test_batch_size, cuda=args.cuda),
+            featureCache, store, testIndices)
+    else:
+        trainDataset = WaveformDataset(store, foldNum, fs=args.fs, train_slices=args.train_slices,
+                                       crops_per_sample=args.crops_per_sample, transform=ToTensor())
+
+    if args.prefetch > 0:
+        train_loader = BatchPrefetcher(trainDataset, args.batch_size, shuffle=True, num_workers=args.num_workers,
+                                       depth=args.prefetch, cuda=args.cuda)
+    else:
+        train_loader = DataLoader(trainDataset, batch_size=args.batch_size, shuffle=True,
+                                  num_workers=args.num_workers)
+    augment = None
+    if args.augment:
+        augment = BatchAugment(args.augment.split(','), mixup_alpha=args.mixup_alpha, seed=args.seed + foldNum)
+    profiler = None
+    if args.profile:
+        profiler = LayerProfiler(model, args.profile + '_fold' + str(foldNum), cuda=args.cuda)
 
     best_acc = 0.0
+    # time-to-accuracy: train_time leaves out the tests, wall time counts everything since the fold started
+    fold_start = time.time()
+    train_time = 0.0
+    samples_seen = 0
     for epoch in range(1, args.epochs + 1):
     # for epoch in range(1, 2):
         exp_lr_scheduler.step()
 
-        train(model, optimizer, train_loader, epoch)
+        start = time.time()
+        if profiler is not None:
+            profiler.begin('train')
+        if args.phase == 2:
+            samples_seen += train_phase2(model, optimizer, train_loader, epoch, profiler)
+        else:
+            samples_seen += train(model, optimizer, train_loader, epoch, augment, profiler)
+        if profiler is not None:
+            profiler.end(epoch)
+        train_time += time.time() - start
 
         #  test and save the best model
-        if epoch % 40 == 0:
-            test_acc = test(model, validPkl)
+        if epoch % args.val_interval == 0 or epoch == args.epochs:
+            if profiler is not None:
+                profiler.begin('test')
+            if args.phase == 2:
+                test_acc = test_phase2(model, testDataset)
+            else:
+                test_acc = test(model, store, foldNum)
+            if profiler is not None:
+                profiler.end(epoch)
+            if args.curve:
+                with open(args.curve, 'a') as f:
+                    f.write(json.dumps({'fold': foldNum, 'epoch': epoch, 'train_s': train_time,
+                                        'wall_s': time.time() - fold_start, 'samples': samples_seen,
+                                        'lr': optimizer.param_groups[0]['lr'], 'test_acc': test_acc}) + '\n')
             if test_acc > best_acc:
                 best_acc = test_acc
                 # best_model_wts = model.state_dict()
 
-                model_name = '../model/' + args.network + '_fold' + str(foldNum) + '_epoch' + str(epoch) + '.pkl'
+                model_name = '../model/' + args.network + ('_phase2' if args.phase == 2 else '') + \
+                             ('_fs' + str(args.fs) if args.fs != 44100 else '') + \
+                             '_fold' + str(foldNum) + '_epoch' + str(epoch) + '.pkl'
                 torch.save(model, model_name)
                 print('model has been saved as: ' + model_name)
+            if args.target_acc is not None and test_acc >= args.target_acc:
+                print('TestACC {:.2f}% reached at epoch {} after {:.1f}s of training'.format(
+                    args.target_acc, epoch, train_time))
+                break
+
+    print('best TestACC on fold {}: {:.2f}%'.format(foldNum, best_acc))
+    return best_acc
 
 
 def main():
     print(args.network)
-    for fold_num in range(5):
-        trainPkl = '../data_wave_44100/fold' + str(fold_num) + '_train.cPickle'
-        validPkl = '../data_wave_44100/fold' + str(fold_num) + '_test.cPickle'
+    # all folds are index views over this single memory-mapped store
+    store = load_store('../data_wave_' + str(args.fs) + ('' if args.store_dtype == 'float32' else '_' + args.store_dtype))
+    if args.shared_memory:
+        store = share_store(store)
+    folds = range(5) if args.fold is None else [args.fold]
+
+    if args.mode == 'test':
+        model = torch.load(args.model)
+        check_clip_inference(model)
+        if args.cuda:
+            model.cuda()
+        for fold_num in folds:
+            test(model, store, fold_num)
+        return
+
+    best_accs = []
+    for fold_num in folds:
         start = time.time()
-        main_on_fold(fold_num, trainPkl, validPkl)
+        best_accs.append(main_on_fold(fold_num, store))
         print('time on fold: %fs' % (time.time() - start))
 
+    if len(best_accs) > 1:
+        print('mean TestACC: {:.2f}% (std {:.2f})'.format(np.mean(best_accs), np.std(best_accs)))
+
 if __name__ == "__main__":
     main()
 
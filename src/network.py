@@ -8,10 +8,13 @@ import wave
 import numpy as np
 
 import math
+import copy
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from util import frontend_hop, window_length, fft_size
 import torch.optim as optim
 from torch.optim import lr_scheduler
 
@@ -28,10 +31,178 @@ def num_flat_features(x):
     return num_features
 
 
+def backend_features(frames, bins=96):
+    """
+    in-features of fc1 for a (bins, frames) input of the backend: pool3 (3, 11),
+    then three (2, 2) pools of 256 channels. 5120 for the 441 frames at 44.1kHz.
+    """
+    return 256 * (bins // 3 // 2 // 2 // 2) * (frames // 11 // 2 // 2 // 2)
+
+
+def frontend_parameters(model):
+    """
+    (name, parameter) of the waveform frontend, conv1_x, bn1_x, conv2_x and bn2_x.
+    """
+    return [(name, p) for name, p in model.named_parameters()
+            if name.split('.')[0].split('_')[0] in ('conv1', 'bn1', 'conv2', 'bn2')]
+
+
+def folded_conv(conv, bn):
+    """
+    weight and bias of conv followed by bn in eval mode.
+    """
+    if not isinstance(bn, (nn.BatchNorm1d, nn.BatchNorm2d)):
+        return conv.weight, conv.bias  # already folded, see fold_batchnorm
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    return conv.weight * scale.view([-1] + [1] * (conv.weight.dim() - 1)), (bias - bn.running_mean) * scale + bn.bias
+
+
+class BranchFunction(object):
+    """
+    pool(bn2(conv2(relu(bn1(conv1(x)))))) of one frontend branch, run under checkpoint.
+
+    the second call is the recompute of the backward pass: BatchNorm momentum is 0 there,
+    so the running statistics are updated once per step as without checkpointing.
+    """
+    def __init__(self, conv1, bn1, conv2, bn2, pool):
+        self.conv1, self.bn1, self.conv2, self.bn2, self.pool = conv1, bn1, conv2, bn2, pool
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        momentum = self.bn1.momentum, self.bn2.momentum
+        if self.calls > 1:
+            self.bn1.momentum = self.bn2.momentum = 0.
+        try:
+            return self.pool(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(x))))))
+        finally:
+            self.bn1.momentum, self.bn2.momentum = momentum
+
+
+def multiscale_frontend(model, x, branches=('1', '2', '3'), out=None):
+    """
+    waveform frontend of the WaveMsNet variants: for each branch s,
+    relu(bn2_s(conv2_s(relu(bn1_s(conv1_s(x)))))) max-pooled by pool2_s, stacked along the
+    frequency axis in branch order.
+
+    relu commutes with max pooling, so it runs after pool2_s on a 1/hop sized tensor
+    instead of on the full resolution conv output. In eval mode without autograd the
+    BatchNorms are folded into the convolutions on the fly, the inner relu is in place, and
+    the pooled maps are written straight into one (batchSize, 1L, channels, frames) output
+    without a cat. Branches are trimmed to the frame count of the shortest one.
+
+    if model.checkpoint_frontend is set, training keeps only the input and the pooled maps
+    of each branch; the full resolution activations are recomputed in the backward pass.
+    :param model: module with conv1_s, bn1_s, conv2_s, bn2_s and pool2_s for s in branches.
+    :param out: output of a previous call, reused in the eval path if its shape fits
+                (FrontendCache.build and stream.StreamingPredictor pass it). Training
+                allocates the output of a cat, which autograd needs; it is 1/hop the
+                size of the conv activations.
+    """
+    fused = not model.training and not torch.is_grad_enabled()
+
+    pooled = []
+    for s in branches:
+        conv1, bn1 = getattr(model, 'conv1_' + s), getattr(model, 'bn1_' + s)
+        conv2, bn2 = getattr(model, 'conv2_' + s), getattr(model, 'bn2_' + s)
+        pool = getattr(model, 'pool2_' + s)
+        if fused:
+            weight, bias = folded_conv(conv1, bn1)
+            h = F.relu_(F.conv1d(x, weight, bias, conv1.stride, conv1.padding))
+            weight, bias = folded_conv(conv2, bn2)
+            pooled.append(pool(F.conv1d(h, weight, bias, conv2.stride, conv2.padding)))
+        elif getattr(model, 'checkpoint_frontend', False) and torch.is_grad_enabled():
+            pooled.append(checkpoint(BranchFunction(conv1, bn1, conv2, bn2, pool), x, use_reentrant=False))
+        else:
+            pooled.append(pool(bn2(conv2(F.relu(bn1(conv1(x)))))))
+
+    frames = min(h.size(2) for h in pooled)
+    channels = sum(h.size(1) for h in pooled)
+    if not fused:
+        return torch.unsqueeze(F.relu(torch.cat([h[:, :, :frames] for h in pooled], dim=1)), 1)
+
+    shape = (x.size(0), 1, channels, frames)
+    if out is None or tuple(out.size()) != shape:
+        out = x.new_empty(shape)
+    c = 0
+    for h in pooled:
+        torch.clamp(h[:, :, :frames], min=0, out=out[:, 0, c: c + h.size(1)])
+        c += h.size(1)
+    return out
+
+
+def fold_batchnorm(model):
+    """
+    inference copy of a model with every BatchNorm folded into the convolution before it.
+
+    each bnX is folded into the convX of the same module (bn1_1 into conv1_1, bn3 into
+    conv3, ...) with its running statistics, and replaced by nn.Identity, as is every
+    Dropout. The copy gives the outputs of model.eval() up to float rounding.
+    """
+    model = copy.deepcopy(model).eval()
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, (nn.BatchNorm1d, nn.BatchNorm2d)) and name.startswith('bn'):
+                conv = getattr(parent, 'conv' + name[2:])
+                scale = child.weight.data / torch.sqrt(child.running_var + child.eps)
+                bias = conv.bias.data if conv.bias is not None else torch.zeros_like(child.running_mean)
+                conv.weight.data = conv.weight.data * scale.view([-1] + [1] * (conv.weight.dim() - 1))
+                conv.bias = nn.Parameter((bias - child.running_mean) * scale + child.bias.data)
+                setattr(parent, name, nn.Identity())
+            elif isinstance(child, nn.Dropout):
+                setattr(parent, name, nn.Identity())
+    return model
+
+
+class LogMel(nn.Module):
+    """
+    log-mel spectrogram of a batch of waveforms, computed with torch.
+
+    same features as librosa.feature.melspectrogram followed by librosa.logamplitude
+    (hann window, centered reflect-padded frames, power 2, slaney mel filters, 80 dB floor
+    below the peak of each spectrogram), within float32 precision. The window and the
+    mel filterbank are built once and kept as buffers, so the module follows .cuda().
+    """
+    def __init__(self, fs=44100, n_fft=None, hop_length=None, n_mels=96, top_db=80.0, amin=1e-10):
+        """
+        :param n_fft: default util.fft_size(fs), 2048 at 44.1kHz
+        :param hop_length: default util.frontend_hop(fs), 150 at 44.1kHz
+        """
+        super(LogMel, self).__init__()
+        n_fft = n_fft or fft_size(fs)
+        hop_length = hop_length or frontend_hop(fs)
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.top_db = top_db
+        self.amin = amin
+        self.register_buffer('window', torch.hann_window(n_fft))
+        mel_basis = librosa.filters.mel(sr=fs, n_fft=n_fft, n_mels=n_mels)  # (n_mels, 1 + n_fft/2)
+        self.register_buffer('mel_basis', torch.from_numpy(mel_basis).float())
+
+    def forward(self, x):
+        # input: (batchSize, 1L, 66150L) or (batchSize, 66150L)
+        x = x.view(x.size(0), -1)
+        frames = x.size(1) // self.hop_length  # 441, as the frames of the WaveMsNet frontend
+        spec = torch.stft(x, self.n_fft, hop_length=self.hop_length, window=self.window,
+                          center=True, pad_mode='reflect', return_complex=True)
+        power = spec.real ** 2 + spec.imag ** 2  # (batchSize, 1025L, 442L)
+        melspec = torch.matmul(self.mel_basis, power)
+
+        logmel = 10.0 * torch.log10(torch.clamp(melspec, min=self.amin))
+        if self.top_db is not None:
+            peak = logmel.view(logmel.size(0), -1).max(dim=1)[0].view(-1, 1, 1)
+            logmel = torch.max(logmel, peak - self.top_db)
+        return torch.unsqueeze(logmel[:, :, :frames], 1)  # (batchSize, 1L, 96L, 441L)
+
 
 class WaveMsNet(nn.Module):
-    def __init__(self):
+    def __init__(self, fs=44100):
         super(WaveMsNet, self).__init__()
+        # samples per frame of the frontend output, 150 = 1 * 150 = 5 * 30 = 10 * 15 at 44.1kHz
+        self.hop = frontend_hop(fs)
+        self.win_size = window_length(fs)
+
         self.conv1_1 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=11, stride=1, padding=5)
         self.conv1_2 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=51, stride=5, padding=25)
         self.conv1_3 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=101, stride=10, padding=50)
@@ -48,9 +219,9 @@ class WaveMsNet(nn.Module):
         self.bn2_2 = nn.BatchNorm1d(32)
         self.bn2_3 = nn.BatchNorm1d(32)
 
-        self.pool2_1 = nn.MaxPool1d(kernel_size=150, stride=150)
-        self.pool2_2 = nn.MaxPool1d(kernel_size=30, stride=30)
-        self.pool2_3 = nn.MaxPool1d(kernel_size=15, stride=15)
+        self.pool2_1 = nn.MaxPool1d(kernel_size=self.hop, stride=self.hop)
+        self.pool2_2 = nn.MaxPool1d(kernel_size=self.hop // 5, stride=self.hop // 5)
+        self.pool2_3 = nn.MaxPool1d(kernel_size=self.hop // 10, stride=self.hop // 10)
 
         self.conv3 = nn.Conv2d(in_channels=1, out_channels=64, kernel_size=3, stride=1, padding=1)
         self.bn3 = nn.BatchNorm2d(64)
@@ -68,33 +239,28 @@ class WaveMsNet(nn.Module):
         self.bn6 = nn.BatchNorm2d(256)
         self.pool6 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
 
-        self.fc1 = nn.Linear(5120, 4096)
+        self.fc1 = nn.Linear(backend_features(self.win_size // self.hop), 4096)
         self.fc2 = nn.Linear(4096, 50)
         # self.fc3 = nn.Linear(4096, 50)
 
         self.dropout = nn.Dropout(p=0.5)
         self.relu = nn.ReLU()
 
-    def forward(self, x):
+    def frontend(self, x, out=None):
+        """
+        multi-scale convolution over a waveform of any length, see multiscale_frontend.
+        frame t of the output only depends on samples around [t * hop, (t+1) * hop),
+        so a long input can be cropped into windows after the frontend.
+        """
         # input: (batchSize, 1L, 66150L)
-        x1 = self.relu(self.bn1_1(self.conv1_1(x)))
-        x2 = self.relu(self.bn1_2(self.conv1_2(x)))
-        x3 = self.relu(self.bn1_3(self.conv1_3(x)))
+        return multiscale_frontend(self, x, ('1', '2', '3'), out)  # (batchSize, 1L, 96L, 441L)
 
-        x1 = self.relu(self.bn2_1(self.conv2_1(x1)))
-        x2 = self.relu(self.bn2_2(self.conv2_2(x2)))
-        x3 = self.relu(self.bn2_3(self.conv2_3(x3)))
-
-        x1 = self.pool2_1(x1)
-        x2 = self.pool2_2(x2)
-        x3 = self.pool2_3(x3)  # (batchSize, 32L, 441L)
-
-        x1 = torch.unsqueeze(x1, 1)
-        x2 = torch.unsqueeze(x2, 1)
-        x3 = torch.unsqueeze(x3, 1)  # (batchSize, 1L, 32L, 441L)
-
-        h = torch.cat((x1, x2, x3), dim=2) #(batchSize, 1L, 96L, 441L)
+    def forward(self, x):
+        # input: (batchSize, 1L, 66150L)
+        return self.backend(self.frontend(x))
 
+    def backend(self, h):
+        # input: (batchSize, 1L, 96L, 441L)
         h = self.conv3(h)
         h = self.bn3(h)
         h = self.relu(h)
@@ -126,8 +292,11 @@ class WaveMsNet_Logmel(nn.Module):
     """
     Backend of the Network. It will be trained by Log-Mel feature.
     """
-    def __init__(self):
+    def __init__(self, fs=44100):
         super(WaveMsNet_Logmel, self).__init__()
+        # frames of the LogMel features of a window
+        self.hop = frontend_hop(fs)
+        self.win_size = window_length(fs)
 
         self.conv3 = nn.Conv2d(in_channels=1, out_channels=64, kernel_size=3, stride=1, padding=1)
         self.bn3 = nn.BatchNorm2d(64)
@@ -145,7 +314,7 @@ class WaveMsNet_Logmel(nn.Module):
         self.bn6 = nn.BatchNorm2d(256)
         self.pool6 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
 
-        self.fc1 = nn.Linear(5120, 4096)
+        self.fc1 = nn.Linear(backend_features(self.win_size // self.hop), 4096)
         self.fc2 = nn.Linear(4096, 50)
         # self.fc3 = nn.Linear(4096, 50)
 
@@ -183,10 +352,77 @@ class WaveMsNet_Logmel(nn.Module):
 
 
 
+class QuantWaveMsNet(nn.Module):
+    """
+    int8 inference copy of a trained WaveMsNet or WaveMsNet_Logmel, built by quantize.py.
+
+    conv + bn + relu are fused and the conv stacks run statically quantized between a
+    QuantStub and a DeQuantStub (their ranges come from a calibration pass); fc1 and fc2
+    are dynamically quantized Linear layers. The LogMel module of
+    nn.Sequential(LogMel(), WaveMsNet_Logmel()) stays in float32.
+    """
+    def __init__(self, model):
+        """
+        :param model: float model in eval mode, WaveMsNet, WaveMsNet_Logmel or
+                      nn.Sequential(LogMel(), WaveMsNet_Logmel()). Its modules are reused.
+        """
+        super(QuantWaveMsNet, self).__init__()
+        self.logmel = None
+        if isinstance(model, nn.Sequential):
+            self.logmel, model = model[0], model[1]
+
+        # multi-scale frontend branches, none for WaveMsNet_Logmel
+        self.branches = nn.ModuleList()
+        i = 1
+        while hasattr(model, 'conv1_%d' % i):
+            self.branches.append(nn.Sequential(
+                getattr(model, 'conv1_%d' % i), getattr(model, 'bn1_%d' % i), nn.ReLU(),
+                getattr(model, 'conv2_%d' % i), getattr(model, 'bn2_%d' % i), nn.ReLU(),
+                getattr(model, 'pool2_%d' % i)).eval())
+            torch.quantization.fuse_modules(self.branches[-1], [['0', '1', '2'], ['3', '4', '5']], inplace=True)
+            i += 1
+        self.cat = nn.quantized.FloatFunctional()
+
+        self.blocks = nn.Sequential()
+        for i in range(3, 7):
+            block = nn.Sequential(getattr(model, 'conv%d' % i), getattr(model, 'bn%d' % i), nn.ReLU(),
+                                  getattr(model, 'pool%d' % i)).eval()
+            torch.quantization.fuse_modules(block, [['0', '1', '2']], inplace=True)
+            self.blocks.add_module(str(i), block)
+
+        self.fc1 = model.fc1
+        self.fc2 = model.fc2
+        self.dropout = model.dropout
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        # input: (batchSize, 1L, 66150L)
+        if self.logmel is not None:
+            x = self.logmel(x)  # (batchSize, 1L, 96L, 441L)
+        h = self.quant(x)
+
+        if len(self.branches):
+            hs = [branch(h) for branch in self.branches]
+            frames = min(b.size(2) for b in hs)
+            h = self.cat.cat([torch.unsqueeze(b[:, :, :frames], 1) for b in hs], dim=2)  # (batchSize, 1L, 96L, 441L)
+
+        h = self.blocks(h)  # (bs, 256L, 4L, 5L)
+        h = self.dequant(h)
+
+        h = h.reshape(h.size(0), -1)  # (batchSize, 5120L)
+        h = F.relu(self.fc1(h))
+        h = self.dropout(h)
+        h = self.fc2(h)
+        return h
+
+
 class WaveMsNet_srf_fixed_logmel(nn.Module):
-    def __init__(self, phase):
-        super(M9_srf_fixed_logmel, self).__init__()
+    def __init__(self, phase=1, fs=44100):
+        super(WaveMsNet_srf_fixed_logmel, self).__init__()
         self.phase = phase
+        self.hop = frontend_hop(fs)
+        self.win_size = window_length(fs)
         self.conv1_1 = nn.Conv1d(in_channels=1, out_channels=96, kernel_size=11, stride=1, padding=5)
 
         self.bn1_1 = nn.BatchNorm1d(96)
@@ -195,7 +431,7 @@ class WaveMsNet_srf_fixed_logmel(nn.Module):
 
         self.bn2_1 = nn.BatchNorm1d(96)
 
-        self.pool2_1 = nn.MaxPool1d(kernel_size=150, stride=150)
+        self.pool2_1 = nn.MaxPool1d(kernel_size=self.hop, stride=self.hop)
 
         self.conv3 = nn.Conv2d(in_channels=2, out_channels=64, kernel_size=3, stride=1, padding=1)
         self.bn3 = nn.BatchNorm2d(64)
@@ -213,7 +449,7 @@ class WaveMsNet_srf_fixed_logmel(nn.Module):
         self.bn6 = nn.BatchNorm2d(256)
         self.pool6 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
 
-        self.fc1 = nn.Linear(5120, 4096)
+        self.fc1 = nn.Linear(backend_features(self.win_size // self.hop), 4096)
         self.fc2 = nn.Linear(4096, 10)
         # self.fc3 = nn.Linear(4096, 50)
 
@@ -223,21 +459,21 @@ class WaveMsNet_srf_fixed_logmel(nn.Module):
     def changePhase(self, newphase):
         self.phase = newphase
 
-    def forward(self, x, feats=None):
+    def frontend(self, x, out=None):
         # input: (batchSize, 1L, 66150L)
-        x1 = self.relu(self.bn1_1(self.conv1_1(x)))
-
-        x1 = self.relu(self.bn2_1(self.conv2_1(x1)))
-
-        x1 = self.pool2_1(x1)
-
-        x1 = torch.unsqueeze(x1, 1)
+        return multiscale_frontend(self, x, ('1',), out)  # (batchSize, 1L, 96L, 441L)
 
+    def forward(self, x, feats=None):
+        # input: (batchSize, 1L, 66150L), feats: (batchSize, 1L, 96L, 441L) in phase 2
+        h = self.frontend(x)
         if self.phase == 1:
-            h = torch.cat((x1, x1), dim=1)  # (batchSize, 2L, 96L, 441L)
+            h = torch.cat((h, h), dim=1)  # (batchSize, 2L, 96L, 441L)
         elif self.phase == 2:
-            h = torch.cat((x1, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+            h = torch.cat((h, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+        return self.backend(h)
 
+    def backend(self, h):
+        # input: (batchSize, 2L, 96L, 441L)
         h = self.conv3(h)
         h = self.bn3(h)
         h = self.relu(h)
@@ -266,9 +502,11 @@ class WaveMsNet_srf_fixed_logmel(nn.Module):
 
 
 class WaveMsNet_mrf_fixed_logmel(nn.Module):
-    def __init__(self, phase):
-        super(M9_mrf_fixed_logmel, self).__init__()
+    def __init__(self, phase=1, fs=44100):
+        super(WaveMsNet_mrf_fixed_logmel, self).__init__()
         self.phase = phase
+        self.hop = frontend_hop(fs)
+        self.win_size = window_length(fs)
         self.conv1_2 = nn.Conv1d(in_channels=1, out_channels=96, kernel_size=51, stride=5, padding=25)
 
         self.bn1_2 = nn.BatchNorm1d(96)
@@ -277,7 +515,7 @@ class WaveMsNet_mrf_fixed_logmel(nn.Module):
 
         self.bn2_2 = nn.BatchNorm1d(96)
 
-        self.pool2_2 = nn.MaxPool1d(kernel_size=30, stride=30)
+        self.pool2_2 = nn.MaxPool1d(kernel_size=self.hop // 5, stride=self.hop // 5)
 
         self.conv3 = nn.Conv2d(in_channels=2, out_channels=64, kernel_size=3, stride=1, padding=1)
         self.bn3 = nn.BatchNorm2d(64)
@@ -295,7 +533,7 @@ class WaveMsNet_mrf_fixed_logmel(nn.Module):
         self.bn6 = nn.BatchNorm2d(256)
         self.pool6 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
 
-        self.fc1 = nn.Linear(5120, 4096)
+        self.fc1 = nn.Linear(backend_features(self.win_size // self.hop), 4096)
         self.fc2 = nn.Linear(4096, 10)
         # self.fc3 = nn.Linear(4096, 50)
 
@@ -305,21 +543,21 @@ class WaveMsNet_mrf_fixed_logmel(nn.Module):
     def changePhase(self, newphase):
         self.phase = newphase
 
-    def forward(self, x, feats=None):
+    def frontend(self, x, out=None):
         # input: (batchSize, 1L, 66150L)
-        x2 = self.relu(self.bn1_2(self.conv1_2(x)))
-
-        x2 = self.relu(self.bn2_2(self.conv2_2(x2)))
-
-        x2 = self.pool2_2(x2)  # (batchSize, 96L, 441L)
-
-        x2 = torch.unsqueeze(x2, 1)  # (batchSize, 1L, 96L, 441L)
+        return multiscale_frontend(self, x, ('2',), out)  # (batchSize, 1L, 96L, 441L)
 
+    def forward(self, x, feats=None):
+        # input: (batchSize, 1L, 66150L), feats: (batchSize, 1L, 96L, 441L) in phase 2
+        h = self.frontend(x)
         if self.phase == 1:
-            h = torch.cat((x2, x2), dim=1)  # (batchSize, 2L, 96L, 441L)
+            h = torch.cat((h, h), dim=1)  # (batchSize, 2L, 96L, 441L)
         elif self.phase == 2:
-            h = torch.cat((x2, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+            h = torch.cat((h, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+        return self.backend(h)
 
+    def backend(self, h):
+        # input: (batchSize, 2L, 96L, 441L)
         h = self.conv3(h)
         h = self.bn3(h)
         h = self.relu(h)
@@ -347,9 +585,11 @@ class WaveMsNet_mrf_fixed_logmel(nn.Module):
         return h
 
 class WaveMsNet_lrf_fixed_logmel(nn.Module):
-    def __init__(self, phase):
-        super(M9_lrf_fixed_logmel, self).__init__()
+    def __init__(self, phase=1, fs=44100):
+        super(WaveMsNet_lrf_fixed_logmel, self).__init__()
         self.phase = phase
+        self.hop = frontend_hop(fs)
+        self.win_size = window_length(fs)
         self.conv1_3 = nn.Conv1d(in_channels=1, out_channels=96, kernel_size=101, stride=10, padding=50)
 
         self.bn1_3 = nn.BatchNorm1d(96)
@@ -358,7 +598,7 @@ class WaveMsNet_lrf_fixed_logmel(nn.Module):
 
         self.bn2_3 = nn.BatchNorm1d(96)
 
-        self.pool2_3 = nn.MaxPool1d(kernel_size=15, stride=15)
+        self.pool2_3 = nn.MaxPool1d(kernel_size=self.hop // 10, stride=self.hop // 10)
 
         self.conv3 = nn.Conv2d(in_channels=2, out_channels=64, kernel_size=3, stride=1, padding=1)
         self.bn3 = nn.BatchNorm2d(64)
@@ -376,7 +616,7 @@ class WaveMsNet_lrf_fixed_logmel(nn.Module):
         self.bn6 = nn.BatchNorm2d(256)
         self.pool6 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
 
-        self.fc1 = nn.Linear(5120, 4096)
+        self.fc1 = nn.Linear(backend_features(self.win_size // self.hop), 4096)
         self.fc2 = nn.Linear(4096, 10)
         # self.fc3 = nn.Linear(4096, 50)
 
@@ -386,21 +626,21 @@ class WaveMsNet_lrf_fixed_logmel(nn.Module):
     def changePhase(self, newphase):
         self.phase = newphase
 
-    def forward(self, x, feats=None):
+    def frontend(self, x, out=None):
         # input: (batchSize, 1L, 66150L)
-        x3 = self.relu(self.bn1_3(self.conv1_3(x)))
-
-        x3 = self.relu(self.bn2_3(self.conv2_3(x3)))
-
-        x3 = self.pool2_3(x3)  # (batchSize, 32L, 441L)
-
-        x3 = torch.unsqueeze(x3, 1)  # (batchSize, 1L, 32L, 441L)
+        return multiscale_frontend(self, x, ('3',), out)  # (batchSize, 1L, 96L, 441L)
 
+    def forward(self, x, feats=None):
+        # input: (batchSize, 1L, 66150L), feats: (batchSize, 1L, 96L, 441L) in phase 2
+        h = self.frontend(x)
         if self.phase == 1:
-            h = torch.cat((x3, x3), dim=1)  # (batchSize, 2L, 96L, 441L)
+            h = torch.cat((h, h), dim=1)  # (batchSize, 2L, 96L, 441L)
         elif self.phase == 2:
-            h = torch.cat((x3, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+            h = torch.cat((h, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+        return self.backend(h)
 
+    def backend(self, h):
+        # input: (batchSize, 2L, 96L, 441L)
         h = self.conv3(h)
         h = self.bn3(h)
         h = self.relu(h)
@@ -428,9 +668,11 @@ class WaveMsNet_lrf_fixed_logmel(nn.Module):
         return h
 
 class WaveMsNet_fixed_logmel(nn.Module):
-    def __init__(self, phase):
-        super(M9_fixed_logmel, self).__init__()
+    def __init__(self, phase=1, fs=44100):
+        super(WaveMsNet_fixed_logmel, self).__init__()
         self.phase = phase
+        self.hop = frontend_hop(fs)
+        self.win_size = window_length(fs)
         self.conv1_1 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=11, stride=1, padding=5)
         self.conv1_2 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=51, stride=5, padding=25)
         self.conv1_3 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=101, stride=10, padding=50)
@@ -447,9 +689,9 @@ class WaveMsNet_fixed_logmel(nn.Module):
         self.bn2_2 = nn.BatchNorm1d(32)
         self.bn2_3 = nn.BatchNorm1d(32)
 
-        self.pool2_1 = nn.MaxPool1d(kernel_size=150, stride=150)
-        self.pool2_2 = nn.MaxPool1d(kernel_size=30, stride=30)
-        self.pool2_3 = nn.MaxPool1d(kernel_size=15, stride=15)
+        self.pool2_1 = nn.MaxPool1d(kernel_size=self.hop, stride=self.hop)
+        self.pool2_2 = nn.MaxPool1d(kernel_size=self.hop // 5, stride=self.hop // 5)
+        self.pool2_3 = nn.MaxPool1d(kernel_size=self.hop // 10, stride=self.hop // 10)
 
         self.conv3 = nn.Conv2d(in_channels=2, out_channels=64, kernel_size=3, stride=1, padding=1)
         self.bn3 = nn.BatchNorm2d(64)
@@ -467,7 +709,7 @@ class WaveMsNet_fixed_logmel(nn.Module):
         self.bn6 = nn.BatchNorm2d(256)
         self.pool6 = nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2))
 
-        self.fc1 = nn.Linear(5120, 4096)
+        self.fc1 = nn.Linear(backend_features(self.win_size // self.hop), 4096)
         self.fc2 = nn.Linear(4096, 10)
         # self.fc3 = nn.Linear(4096, 50)
 
@@ -477,31 +719,21 @@ class WaveMsNet_fixed_logmel(nn.Module):
     def changePhase(self, newphase):
         self.phase = newphase
 
-    def forward(self, x, feats=None):
+    def frontend(self, x, out=None):
         # input: (batchSize, 1L, 66150L)
-        x1 = self.relu(self.bn1_1(self.conv1_1(x)))
-        x2 = self.relu(self.bn1_2(self.conv1_2(x)))
-        x3 = self.relu(self.bn1_3(self.conv1_3(x)))
-
-        x1 = self.relu(self.bn2_1(self.conv2_1(x1)))
-        x2 = self.relu(self.bn2_2(self.conv2_2(x2)))
-        x3 = self.relu(self.bn2_3(self.conv2_3(x3)))
-
-        x1 = self.pool2_1(x1)
-        x2 = self.pool2_2(x2)
-        x3 = self.pool2_3(x3)  # (batchSize, 32L, 441L)
-
-        x1 = torch.unsqueeze(x1, 1)
-        x2 = torch.unsqueeze(x2, 1)
-        x3 = torch.unsqueeze(x3, 1)  # (batchSize, 1L, 32L, 441L)
+        return multiscale_frontend(self, x, ('1', '2', '3'), out)  # (batchSize, 1L, 96L, 441L)
 
+    def forward(self, x, feats=None):
+        # input: (batchSize, 1L, 66150L), feats: (batchSize, 1L, 96L, 441L) in phase 2
+        h = self.frontend(x)
         if self.phase == 1:
-            h = torch.cat((x1, x2, x3), dim=2) #(batchSize, 1L, 96L, 441L)
             h = torch.cat((h, h), dim=1)  # (batchSize, 2L, 96L, 441L)
         elif self.phase == 2:
-            h = torch.cat((x1, x2, x3), dim=2)  # (batchSize, 1L, 96L, 441L)
             h = torch.cat((h, feats), dim=1)  # (batchSize, 2L, 96L, 441L)
+        return self.backend(h)
 
+    def backend(self, h):
+        # input: (batchSize, 2L, 96L, 441L)
         h = self.conv3(h)
         h = self.bn3(h)
         h = self.relu(h)
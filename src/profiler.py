@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+opt-in per-layer profiling of the training and test loops (main.py --profile).
+
+"""
+import json
+import resource
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def layer_flops(module, inputs, output):
+    """
+    rough FLOPs of one forward of a leaf module, a multiply-add counts 2.
+    """
+    if isinstance(module, (nn.Conv1d, nn.Conv2d)):
+        return 2 * output.numel() * module.in_channels // module.groups * int(np.prod(module.kernel_size))
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+    if isinstance(module, (nn.MaxPool1d, nn.MaxPool2d)):
+        return output.numel() * int(np.prod(module.kernel_size))
+    if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d)):
+        return 2 * output.numel()
+    if isinstance(module, (nn.ReLU, nn.Dropout)):
+        return output.numel()
+    return 0
+
+
+def tensor_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(tensor_bytes(o) for o in output)
+    return 0
+
+
+def peak_rss():
+    """
+    :return: peak resident memory of the process so far, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # ru_maxrss is in kB
+
+
+class LayerProfiler(object):
+    """
+    forward and backward time, FLOPs estimate and activation bytes of every leaf module
+    of a model (conv1_1 .. pool2_3, conv3 .. conv6, fc1, fc2, ...), plus the frontend()
+    and backend() of the model as a whole, and the data loading against compute time
+    and peak memory of each epoch.
+
+    forward time runs from the pre-hook to the hook of a module. Backward time is the
+    time between the gradient of the output of a module and the next gradient of the
+    backward pass, so it includes autograd ops between the modules. In the fused eval
+    frontend (network.multiscale_frontend) the convolutions run functionally, only
+    pool2_x and the frontend row see them. With cuda, the hooks synchronize the device.
+
+    usage: begin('train'), iterate loader(train_loader), step() after each backward,
+    end(epoch) prints the table and rewrites <path>.json and <path>.trace.json.
+    The hooks are only attached between begin() and end(), so the model can be
+    saved with torch.save outside of them.
+    """
+    def __init__(self, model, path, cuda=False, trace_batches=5):
+        """
+        :param path: output prefix, e.g. '../log/profile'
+        :param trace_batches: batches of each epoch recorded in the Chrome trace.
+        """
+        self.model = model
+        self.path = path
+        self.cuda = cuda
+        self.trace_batches = trace_batches
+        self.handles = []
+        self.summary = []
+        self.trace = []
+        self.t0 = time.time()
+        self.started = {}
+
+    def attach(self):
+        for name, module in self.model.named_modules():
+            if name and not list(module.children()):
+                self.handles.append(module.register_forward_pre_hook(self.pre_hook(name)))
+                self.handles.append(module.register_forward_hook(self.hook(name)))
+        self.handles.append(self.model.register_forward_hook(self.eval_step))
+        for name in ('frontend', 'backend'):
+            if hasattr(self.model, name):
+                # instance attributes shadow the methods until detach()
+                setattr(self.model, name, self.timed(name, getattr(self.model, name)))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for name in ('frontend', 'backend'):
+            self.model.__dict__.pop(name, None)
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.time()
+
+    def begin(self, phase):
+        self.attach()
+        self.phase = phase
+        self.layers = OrderedDict()
+        self.batches = 0
+        self.data_time = 0.
+        self.grads = []
+        self.start = self.sync()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def stats(self, name):
+        if name not in self.layers:
+            self.layers[name] = {'calls': 0, 'forward_s': 0., 'backward_s': 0., 'flops': 0, 'activation_bytes': 0}
+        return self.layers[name]
+
+    def event(self, name, tid, start, end, args=None):
+        if self.batches < self.trace_batches:
+            self.trace.append({'name': name, 'cat': self.phase, 'ph': 'X', 'pid': 0, 'tid': tid,
+                               'ts': 1e6 * (start - self.t0), 'dur': 1e6 * (end - start), 'args': args or {}})
+
+    def pre_hook(self, name):
+        def hook(module, inputs):
+            self.started[name] = self.sync()
+        return hook
+
+    def hook(self, name):
+        def hook(module, inputs, output):
+            end = self.sync()
+            s = self.stats(name)
+            s['calls'] += 1
+            s['forward_s'] += end - self.started[name]
+            flops = layer_flops(module, inputs, output) if isinstance(output, torch.Tensor) else 0
+            s['flops'] += flops
+            s['activation_bytes'] += tensor_bytes(output)
+            self.event(name, 0, self.started[name], end, {'flops': flops, 'bytes': tensor_bytes(output)})
+            if isinstance(output, torch.Tensor) and output.requires_grad:
+                output.register_hook(self.grad_hook(name))
+        return hook
+
+    def eval_step(self, module, inputs, output):
+        # without a backward pass, each forward of the whole model is a batch
+        if not torch.is_grad_enabled():
+            self.batches += 1
+
+    def grad_hook(self, name):
+        def hook(grad):
+            self.grads.append((self.sync(), name))
+        return hook
+
+    def timed(self, name, method):
+        def run(*args, **kwargs):
+            start = self.sync()
+            output = method(*args, **kwargs)
+            end = self.sync()
+            s = self.stats(name)
+            s['calls'] += 1
+            s['forward_s'] += end - start
+            self.event(name, 1, start, end)
+            return output
+        return run
+
+    def loader(self, loader):
+        """
+        iterate loader, timing how long each batch takes to arrive.
+        """
+        it = iter(loader)
+        while True:
+            start = time.time()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            end = time.time()
+            self.data_time += end - start
+            self.event('data', 2, start, end)
+            yield batch
+
+    def step(self):
+        """
+        after loss.backward(): attribute the backward pass to the layers.
+        """
+        end = self.sync()
+        self.grads.sort()
+        for k, (t, name) in enumerate(self.grads):
+            t_next = self.grads[k + 1][0] if k + 1 < len(self.grads) else end
+            self.stats(name)['backward_s'] += t_next - t
+            self.event(name, 3, t, t_next)
+        self.grads = []
+        self.batches += 1
+
+    def end(self, epoch):
+        """
+        print the table of the epoch and rewrite the JSON summary and Chrome trace.
+        """
+        elapse = self.sync() - self.start
+        self.detach()
+        record = OrderedDict([('epoch', epoch), ('phase', self.phase), ('batches', self.batches),
+                              ('elapse_s', elapse), ('data_s', self.data_time),
+                              ('compute_s', elapse - self.data_time), ('peak_rss_mb', peak_rss())])
+        if self.cuda:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2.**20
+        record['layers'] = self.layers
+        self.summary.append(record)
+        self.print_table(record)
+
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.summary, f, indent=1)
+        with open(self.path + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': self.trace, 'displayTimeUnit': 'ms'}, f)
+
+    def print_table(self, record):
+        print('{} epoch {}: {:.1f}s, data {:.1f}s, compute {:.1f}s, peak RSS {:.0f}MB{}'.format(
+            record['phase'], record['epoch'], record['elapse_s'], record['data_s'], record['compute_s'],
+            record['peak_rss_mb'],
+            ', peak cuda {:.0f}MB'.format(record['peak_cuda_mb']) if 'peak_cuda_mb' in record else ''))
+        # time% is the share of the compute time of the epoch
+        layers = [(name, s) for name, s in record['layers'].items() if name not in ('frontend', 'backend')]
+        total = record['compute_s'] or 1.
+        print('{:<12s} {:>6s} {:>10s} {:>10s} {:>6s} {:>9s} {:>10s}'.format(
+            'layer', 'calls', 'fwd(ms)', 'bwd(ms)', 'time%', 'GFLOP', 'act(MB)'))
+        for name, s in list(layers) + [(name, record['layers'][name]) for name in ('frontend', 'backend')
+                                       if name in record['layers']]:
+            print('{:<12s} {:6d} {:10.1f} {:10.1f} {:6.1f} {:9.2f} {:10.1f}'.format(
+                name, s['calls'], 1000 * s['forward_s'], 1000 * s['backward_s'],
+                100 * (s['forward_s'] + s['backward_s']) / total, s['flops'] / 1e9, s['activation_bytes'] / 2.**20))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+int8 export of trained WaveMsNet / WaveMsNet_Logmel models for cpu inference.
+
+usage:
+    python quantize.py --model='../model/WaveMsNet_fold{}_epoch160.pkl'
+    python quantize.py --model='../model/WaveMsNet_Logmel_fold{}_epoch160.pkl' --fold=0 --calib_batches=20
+
+for each fold, the float model of that fold is quantized (network.QuantWaveMsNet:
+static int8 conv stacks calibrated on random crops of the train split, dynamic int8
+fc1/fc2), traced and saved next to it as the TorchScript graph <model>_int8.pt
+(util.load_model loads it). Size, latency at batch size 1 and
+32, and test accuracy of both models are printed.
+
+"""
+import argparse
+import copy
+import io
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from network import *
+from data_process import *
+from inference import *
+from util import *
+
+
+def quantize(model, calib_loader, calib_batches=10, backend='fbgemm'):
+    """
+    :param model: float model, left unchanged.
+    :return: QuantWaveMsNet in eval mode.
+    """
+    torch.backends.quantized.engine = backend
+    qmodel = QuantWaveMsNet(copy.deepcopy(model).cpu().eval()).eval()
+    qmodel.qconfig = torch.quantization.get_default_qconfig(backend)
+    # log-mel and the fc layers are not statically quantized
+    for module in (qmodel.logmel, qmodel.fc1, qmodel.fc2, qmodel.dropout):
+        if module is not None:
+            module.qconfig = None
+    torch.quantization.prepare(qmodel, inplace=True)
+
+    # calibration: observe the activation ranges of the conv stacks
+    with torch.no_grad():
+        for idx, (data, label) in enumerate(calib_loader):
+            if idx == calib_batches:
+                break
+            qmodel(data)
+    torch.quantization.convert(qmodel, inplace=True)
+
+    return torch.quantization.quantize_dynamic(qmodel, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def model_size(model):
+    """
+    :return: MB of the serialized state dict.
+    """
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2.**20
+
+
+def latency(model, batch_size, repeats=10, win_size=66150):
+    """
+    :return: median ms per forward of a (batch_size, 1, win_size) batch.
+    """
+    x = torch.randn(batch_size, 1, win_size)
+    times = []
+    with torch.no_grad():
+        model(x)  # warm up
+        for _ in range(repeats):
+            start = time.time()
+            model(x)
+            times.append(time.time() - start)
+    return 1000 * np.median(times)
+
+
+def accuracy(model, store, indices, win_size, stride, batch_size):
+    scores, num_wins = window_scores(model, store['data'], indices, win_size, stride, batch_size,
+                                     scale=store['scale'])
+    label = torch.from_numpy(store['label'][indices])
+    return 100. * scores.max(1)[1].eq(label).sum().item() / len(indices)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='int8 quantization of trained models')
+    parser.add_argument('--model', type=str, required=True,
+                        help='float model path, {} is replaced by the fold number')
+    parser.add_argument('--fs', type=int, default=44100, help='sample rate of the store and the models')
+    parser.add_argument('--store', type=str, default=None, help='waveform store (default: ../data_wave_<fs>)')
+    parser.add_argument('--fold', type=int, default=None, help='only this fold (default: all five folds)')
+    parser.add_argument('--calib_batches', type=int, default=10, help='train batches for calibration')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--test_slices_interval', type=float, default=0.2, help='seconds between test windows')
+    parser.add_argument('--backend', type=str, default='fbgemm', help='fbgemm (x86) or qnnpack (arm)')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    store = load_store(args.store or '../data_wave_' + str(args.fs))
+    folds = range(5) if args.fold is None else [args.fold]
+    win_size = window_length(args.fs)
+    stride = int(args.fs * args.test_slices_interval)
+
+    print('{:>4s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>9s} {:>9s} {:>7s}'.format(
+        'fold', 'fp32(MB)', 'int8(MB)', 'fp32@1', 'int8@1', 'fp32@32', 'int8@32', 'fp32acc', 'int8acc', 'delta'))
+    deltas = []
+    for fold_num in folds:
+        path = args.model.format(fold_num)
+        model = load_model(path)
+
+        calibDataset = WaveformDataset(store, fold_num, 'train', fs=args.fs, transform=ToTensor())
+        calib_loader = DataLoader(calibDataset, batch_size=args.batch_size, shuffle=True)
+        qmodel = quantize(model, calib_loader, args.calib_batches, args.backend)
+        # quantized modules are saved as a graph, traced on one window
+        qpath = path.rsplit('.', 1)[0] + '_int8.pt'
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(qmodel, torch.zeros(1, 1, win_size)), qpath)
+
+        testIndices = load_fold(store['dir'], fold_num, 'test')
+        acc = accuracy(model, store, testIndices, win_size, stride, args.batch_size)
+        qacc = accuracy(qmodel, store, testIndices, win_size, stride, args.batch_size)
+        deltas.append(qacc - acc)
+
+        print('{:4d} {:10.1f} {:10.1f} {:8.1f}ms {:8.1f}ms {:8.1f}ms {:8.1f}ms {:8.2f}% {:8.2f}% {:+6.2f}'.format(
+            fold_num, model_size(model), model_size(qmodel),
+            latency(model, 1, win_size=win_size), latency(qmodel, 1, win_size=win_size),
+            latency(model, 32, win_size=win_size), latency(qmodel, 32, win_size=win_size),
+            acc, qacc, qacc - acc))
+        print('saved ' + qpath)
+
+    if len(deltas) > 1:
+        print('mean accuracy delta: {:+.2f}'.format(np.mean(deltas)))
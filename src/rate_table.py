@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+storage, throughput and accuracy of the pipeline against the sample rate.
+
+usage:
+    python rate_table.py --rates=16000,22050,44100
+    python rate_table.py --network=WaveMsNet --model='../model/WaveMsNet_fs{fs}_fold{fold}_epoch160.pkl'
+
+for each rate, the networks are built for it (util.frontend_hop, util.window_length)
+and run on random windows at --batch_size: 'frontend' is the pooled frontend alone,
+'model' the whole forward. 'MB/clip' is the store ../data_wave_<fs> per clip, or a
+5s float32 clip when there is no store. Test accuracy of each fold is reported
+for the models trained at that rate (main.py --fs, saved with an _fs<fs> suffix
+below 44.1kHz) that exist, '-' otherwise.
+
+"""
+import argparse
+import os
+import time
+import numpy as np
+import torch
+import network
+from inference import window_scores
+from util import *
+
+
+def throughput(fn, x, repeats=5):
+    """
+    :return: windows per second of fn on the batch x.
+    """
+    with torch.no_grad():
+        fn(x)  # warm up
+        start = time.time()
+        for _ in range(repeats):
+            fn(x)
+    return repeats * len(x) / (time.time() - start)
+
+
+def clip_mb(store_dir, fs):
+    if os.path.exists(os.path.join(store_dir, 'data.npy')):
+        data = np.load(os.path.join(store_dir, 'data.npy'), mmap_mode='r')
+        return data.nbytes / float(len(data)) / 2.**20
+    return 5 * fs * 4 / 2.**20
+
+
+def fold_accuracy(path, store, fold_num, fs, batch_size):
+    model = load_model(path)
+    indices = load_fold(store['dir'], fold_num, 'test')
+    scores, num_wins = window_scores(model, store['data'], indices, window_length(fs), int(fs * 0.2), batch_size,
+                                     scale=store['scale'])
+    label = torch.from_numpy(store['label'][indices])
+    return 100. * scores.max(1)[1].eq(label).sum().item() / len(indices)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='per sample rate storage, throughput and accuracy')
+    parser.add_argument('--rates', type=str, default='16000,22050,44100')
+    parser.add_argument('--network', type=str, default='WaveMsNet')
+    parser.add_argument('--model', type=str, default=None,
+                        help='trained model path, {fs} and {fold} are replaced by the rate and the fold number')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    print('{:>6s} {:>5s} {:>7s} {:>8s} {:>13s} {:>10s}   {}'.format(
+        'fs', 'hop', 'window', 'MB/clip', 'frontend(/s)', 'model(/s)', 'test acc fold 0-4'))
+    for fs in [int(r) for r in args.rates.split(',')]:
+        store_dir = '../data_wave_' + str(fs)
+        model = getattr(network, args.network)(fs=fs).eval()
+        x = 0.1 * torch.randn(args.batch_size, 1, model.win_size)
+
+        accs = []
+        for fold_num in range(5):
+            path = args.model.format(fs=fs, fold=fold_num) if args.model else None
+            if path is None or not os.path.exists(path) or not os.path.exists(store_dir):
+                accs.append('-')
+                continue
+            accs.append('{:.2f}'.format(fold_accuracy(path, load_store(store_dir), fold_num, fs, args.batch_size)))
+
+        print('{:6d} {:5d} {:7d} {:8.2f} {:13.0f} {:10.0f}   {}'.format(
+            fs, model.hop, model.win_size, clip_mb(store_dir, fs),
+            throughput(model.frontend, x), throughput(model, x), ' '.join(accs)))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+run the cross-validation folds of main.py in parallel processes.
+
+usage:
+    python run_folds.py --parallel=5 --network=WaveMsNet --epochs=160 --lr=0.01 --momentum=0.9 --weight_decay=5e-4
+
+options not listed below are passed on to main.py. The cores are split into one
+set per parallel fold; each fold process is pinned to its set and gets its share
+of torch threads and DataLoader workers.
+
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from queue import Queue, Empty
+import numpy as np
+
+
+def core_sets(num_sets):
+    """
+    split the cores this process may run on into num_sets contiguous sets.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    size = max(1, len(cores) // num_sets)
+    return [cores[i * size: (i + 1) * size] or cores for i in range(num_sets)]
+
+
+def run_fold(fold_num, cores, main_args, log_dir, num_workers):
+    """
+    :return: best accuracy of the fold parsed from its log, None if it failed.
+    """
+    if num_workers is None:
+        num_workers = max(1, len(cores) // 4)
+    num_threads = max(1, len(cores) - num_workers)
+
+    cmd = [sys.executable, '-u', 'main.py', '--fold=' + str(fold_num),
+           '--num_threads=' + str(num_threads), '--num_workers=' + str(num_workers)] + main_args
+    env = dict(os.environ, OMP_NUM_THREADS=str(num_threads), MKL_NUM_THREADS=str(num_threads))
+    log_path = os.path.join(log_dir, 'fold' + str(fold_num) + '.log')
+
+    print('fold {}: cores {}-{}, {} threads, {} loader workers, log {}'.format(
+        fold_num, cores[0], cores[-1], num_threads, num_workers, log_path))
+    start = time.time()
+    with open(log_path, 'w') as log:
+        # DataLoader workers inherit the affinity of the fold process
+        ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env,
+                              preexec_fn=lambda: os.sched_setaffinity(0, cores))
+
+    best_acc = None
+    with open(log_path, 'r') as log:
+        for line in log:
+            m = re.match(r'best TestACC on fold \d+: ([\d.]+)%', line)
+            if m:
+                best_acc = float(m.group(1))
+    print('fold {}: exit {}, best TestACC {}, {:.1f}s'.format(
+        fold_num, ret, 'n/a' if best_acc is None else '{:.2f}%'.format(best_acc), time.time() - start))
+    return best_acc
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='parallel cross-validation folds')
+    parser.add_argument('--parallel', type=int, default=5, help='folds running at the same time')
+    parser.add_argument('--folds', type=str, default='0,1,2,3,4', help='comma separated fold numbers')
+    parser.add_argument('--loader_workers', type=int, default=None,
+                        help='DataLoader workers per fold (default: a quarter of its cores)')
+    parser.add_argument('--log_dir', type=str, default='../log')
+    args, main_args = parser.parse_known_args()
+
+    folds = [int(f) for f in args.folds.split(',')]
+    parallel = max(1, min(args.parallel, len(folds)))
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    todo = Queue()
+    for fold_num in folds:
+        todo.put(fold_num)
+    results = {}
+
+    def slot(cores):
+        while True:
+            try:
+                fold_num = todo.get_nowait()
+            except Empty:
+                return
+            results[fold_num] = run_fold(fold_num, cores, main_args, args.log_dir, args.loader_workers)
+
+    start = time.time()
+    threads = [threading.Thread(target=slot, args=(cores,)) for cores in core_sets(parallel)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print('\nfold  best TestACC')
+    for fold_num in folds:
+        acc = results.get(fold_num)
+        print('{:4d}  {}'.format(fold_num, 'failed' if acc is None else '{:.2f}%'.format(acc)))
+    accs = [acc for acc in results.values() if acc is not None]
+    if accs:
+        print('mean {:.2f}%  std {:.2f}  ({} folds)'.format(np.mean(accs), np.std(accs), len(accs)))
+    print('total time: {:.1f}s'.format(time.time() - start))
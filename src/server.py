@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+local inference server with dynamic micro-batching.
+
+usage:
+    python server.py --model='../model/WaveMsNet_fold0_epoch160.pkl' --port=8000
+    python server.py --model='...' --unix=/tmp/wavemsnet.sock
+
+    POST /predict   body: raw float32 samples at --fs (Content-Type: application/octet-stream)
+                    or an audio file (any other Content-Type), optional ?top_k=3
+    GET  /stats     request count, p50/p99 latency, queue depth, batch sizes
+    GET  /health
+
+requests longer than a window are split into windows every --hop seconds, their
+logits are summed as in main.test; shorter requests are zero-padded.
+
+"""
+import argparse
+import io
+import json
+import os
+import signal
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue, Empty
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import soundfile
+import torch
+import torch.nn.functional as F
+from network import *
+from util import *
+
+
+class Request(object):
+    """
+    windows of one request and the logits summed over them.
+    """
+    def __init__(self, wins):
+        self.wins = wins  # (n, win_size) float32
+        self.next = 0     # first window not yet batched
+        self.remaining = len(wins)
+        self.scores = None
+        self.error = None
+        self.start = time.time()
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    merge concurrent requests into batches of at most max_batch_size windows.
+
+    a batch is run as soon as it is full, or max_wait seconds after its first window arrived.
+    """
+    def __init__(self, model, win_size=66150, max_batch_size=32, max_wait=0.01, cuda=False):
+        self.model = model.eval()
+        self.win_size = win_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cuda = cuda
+
+        self.queue = Queue()
+        self.buf = torch.zeros(max_batch_size, 1, win_size)
+        self.buf_np = self.buf.numpy()  # same memory, windows are copied in with numpy
+        self.latency = deque(maxlen=10000)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_windows = 0
+        self.lock = threading.Lock()
+
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def submit(self, wins):
+        """
+        :param wins: (n, win_size) float32 windows of one request.
+        :return: summed logits (num_classes,) of the windows, blocks until done.
+        """
+        request = Request(wins)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def stop(self):
+        """
+        finish queued requests, then stop the batching thread.
+        """
+        self.stopping = True
+        self.thread.join()
+
+    def run(self):
+        pending = deque()
+        while True:
+            if not pending:
+                try:
+                    pending.append(self.queue.get(timeout=0.1))
+                except Empty:
+                    if self.stopping:
+                        return
+                    continue
+
+            # take the queued requests, then wait for more until the batch is full
+            # or the first window waited max_wait
+            deadline = pending[0].start + self.max_wait
+            while sum(len(r.wins) - r.next for r in pending) < self.max_batch_size:
+                try:
+                    request = self.queue.get_nowait()
+                except Empty:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = self.queue.get(timeout=timeout)
+                    except Empty:
+                        break
+                pending.append(request)
+            self.step(pending)
+
+    def step(self, pending):
+        # (request, first window, number of windows) in the batch
+        parts = []
+        n = 0
+        for request in pending:
+            m = min(len(request.wins) - request.next, self.max_batch_size - n)
+            if m == 0:
+                break
+            self.buf_np[n: n+m, 0] = request.wins[request.next: request.next+m]
+            parts.append((request, n, m))
+            request.next += m
+            n += m
+        while pending and pending[0].next == len(pending[0].wins):
+            pending.popleft()
+
+        data = self.buf[:n]
+        if self.cuda:
+            data = data.cuda()
+        try:
+            with torch.no_grad():
+                output = self.model(data).cpu()  # (n, 50L)
+        except Exception as e:
+            # fail the requests of this batch, the batcher keeps serving
+            for request, b, m in parts:
+                request.error = e
+                request.done.set()
+            while pending and pending[0].error is not None:
+                pending.popleft()
+            return
+
+        now = time.time()
+        with self.lock:
+            self.num_batches += 1
+            self.num_windows += n
+            for request, b, m in parts:
+                scores = output[b: b+m].sum(0)
+                request.scores = scores if request.scores is None else request.scores + scores
+                request.remaining -= m
+                if request.remaining == 0:
+                    self.num_requests += 1
+                    self.latency.append(now - request.start)
+                    request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latency = np.array(self.latency)
+            stats = {'requests': self.num_requests,
+                     'batches': self.num_batches,
+                     'mean_batch_size': float(self.num_windows) / max(1, self.num_batches),
+                     'queue_depth': self.queue.qsize()}
+        if len(latency):
+            stats['p50_ms'] = 1000 * float(np.percentile(latency, 50))
+            stats['p99_ms'] = 1000 * float(np.percentile(latency, 99))
+        return stats
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self.send_json(200, self.server.batcher.stats())
+        elif path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self.send_json(404, {'error': 'not found'})
+            return
+        top_k = int(parse_qs(url.query).get('top_k', ['3'])[0])
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        try:
+            wave = self.decode(body, self.headers.get('Content-Type', 'application/octet-stream'))
+        except Exception as e:
+            self.send_json(400, {'error': 'cannot decode request: {}'.format(e)})
+            return
+
+        server = self.server
+        if len(wave) < server.win_size:
+            wave = np.r_[wave, np.zeros(server.win_size - len(wave), dtype=np.float32)]
+        wins = sliding_windows(wave, server.win_size, server.stride)
+
+        start = time.time()
+        try:
+            scores = server.batcher.submit(wins)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        prob = F.softmax(scores, dim=0).numpy()
+        top = np.argsort(-prob)[:top_k]
+        self.send_json(200, {'labels': [[id_to_lb(int(k), server.dataset), float(prob[k])] for k in top],
+                             'windows': len(wins),
+                             'latency_ms': 1000 * (time.time() - start)})
+
+    def decode(self, body, content_type):
+        if content_type == 'application/octet-stream':
+            return np.frombuffer(body, dtype='<f4')
+        wave, fs = soundfile.read(io.BytesIO(body), dtype='float32', always_2d=True)
+        wave = wave.mean(axis=1)
+        if fs != self.server.fs:
+            wave = librosa.resample(wave, orig_sr=fs, target_sr=self.server.fs).astype(np.float32)
+        return wave
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = False  # server_close() waits for in-flight requests
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = False
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='WaveMsNet inference server')
+    parser.add_argument('--model', type=str, required=True, help='trained model path')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', type=str, help='serve on this unix socket instead of tcp')
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--hop', type=float, default=0.2, help='seconds between windows of long requests')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='windows per forward')
+    parser.add_argument('--max_wait', type=float, default=0.01,
+                        help='seconds a window may wait for the batch to fill')
+    parser.add_argument('--dataset', type=str, default='ESC-50', help='ESC-10 or ESC-50, for label names')
+    parser.add_argument('--no-cuda', action='store_true', default=False)
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    model = load_model(args.model)
+    if args.cuda:
+        model.cuda()
+    batcher = MicroBatcher(model, window_length(args.fs), max_batch_size=args.max_batch_size, max_wait=args.max_wait, cuda=args.cuda)
+
+    if args.unix:
+        server = UnixServer(args.unix, Handler)
+    else:
+        server = TCPServer((args.host, args.port), Handler)
+    server.batcher = batcher
+    server.fs = args.fs
+    server.win_size = window_length(args.fs)
+    server.stride = int(args.fs * args.hop)
+    server.dataset = args.dataset
+
+    def shutdown(signum, frame):
+        # serve_forever() returns once shutdown() is called from another thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print('serving on {}'.format(args.unix or '{}:{}'.format(args.host, args.port)))
+    server.serve_forever()
+
+    print('shutting down, finishing {} queued requests'.format(batcher.queue.qsize()))
+    server.server_close()
+    batcher.stop()
+    if args.unix and os.path.exists(args.unix):
+        os.unlink(args.unix)
+    print(json.dumps(batcher.stats()))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+real-time classification of a continuous waveform stream.
+
+usage:
+    python stream.py --model='../model/WaveMsNet_fold0_epoch160.pkl' --source='../ESC-10/001 - Dog bark/1-100032-A.ogg'
+
+"""
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from network import *
+from inference import *
+from util import *
+
+
+# half width in samples of the receptive field of a frontend frame,
+# conv1_3 (k=101, s=10) followed by conv2_3 (k=11): 50 + 5 * 10.
+FRONTEND_CONTEXT = 100
+
+
+class RingBuffer(object):
+    """
+    fixed-size buffer along the last axis, addressed by absolute position.
+    """
+    def __init__(self, capacity, shape=(), dtype=np.float32):
+        self.capacity = capacity
+        self.buf = np.zeros(tuple(shape) + (capacity,), dtype=dtype)
+        self.end = 0  # absolute position after the last written item
+
+    def write(self, x):
+        n = x.shape[-1]
+        assert n <= self.capacity
+        i = self.end % self.capacity
+        m = min(n, self.capacity - i)
+        self.buf[..., i: i+m] = x[..., :m]
+        self.buf[..., :n-m] = x[..., m:]
+        self.end += n
+
+    def read(self, start, stop):
+        """
+        items [start, stop) in order, they must still be in the buffer.
+        """
+        assert self.end - self.capacity <= start <= stop <= self.end
+        i = start % self.capacity
+        j = i + stop - start
+        if j <= self.capacity:
+            return self.buf[..., i: j]
+        return np.concatenate((self.buf[..., i:], self.buf[..., :j - self.capacity]), axis=-1)
+
+
+class StreamingPredictor(object):
+    """
+    classify a stream of samples fed in chunks of any size.
+
+    incoming samples go through a ring buffer; the frontend of the model only runs
+    over the samples of the new frames plus FRONTEND_CONTEXT on each side, and the
+    pooled (96L, T) frames are kept in a second ring buffer of one window. Every
+    hop_size samples the backend classifies the last window and a smoothed
+    posterior is emitted.
+
+    frames are computed as if the frontend ran over the whole stream, so posteriors
+    differ from the per-window model only at the zero padding of window edges.
+    """
+    def __init__(self, model, win_size=None, hop_size=8820, smoothing=0.5, fs=44100, cuda=False):
+        """
+        :param model: WaveMsNet or a phase-1 *_fixed_logmel model, see inference.supports_clip_inference.
+        :param win_size: default util.window_length(fs), 66150 at 44.1kHz
+        :param hop_size: samples between posteriors, rounded to a multiple of model.hop
+        :param smoothing: weight of the previous posterior in the exponential average.
+        """
+        if not supports_clip_inference(model):
+            raise ValueError('streaming needs a model with a waveform frontend and backend, '
+                             'e.g. WaveMsNet or a phase-1 *_fixed_logmel model, not ' + type(model).__name__)
+        self.model = model.eval()
+        self.cuda = cuda
+        self.frame_hop = model.hop
+        self.win_frames = (win_size or window_length(fs)) // self.frame_hop
+        self.hop_frames = max(1, int(round(hop_size / float(self.frame_hop))))
+        self.hop_size = self.hop_frames * self.frame_hop
+        # context on each side, in whole frames so frontend output stays frame aligned
+        self.ctx_frames = -(-FRONTEND_CONTEXT // self.frame_hop)
+        self.ctx = self.ctx_frames * self.frame_hop
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        # unprocessed samples never exceed two hops plus the context
+        self.samples = RingBuffer(2 * self.hop_size + 2 * self.ctx + self.frame_hop)
+        # the stream starts with the zero padding the frontend sees at a window edge
+        self.samples.write(np.zeros(self.ctx, dtype=np.float32))
+        self.frames = None
+        self.out = None  # frontend output, the same shape at every hop
+        self.num_frames = 0
+        self.posterior = None
+
+    def feed(self, chunk):
+        """
+        :param chunk: 1-D float32 samples of any length.
+        :return: list of smoothed posteriors (num_classes,) emitted by this chunk, one per hop
+                 once a full window has been received.
+        """
+        posteriors = []
+        for k in range(0, len(chunk), self.hop_size):
+            self.samples.write(np.asarray(chunk[k: k+self.hop_size], dtype=np.float32))
+            # frames whose right context has arrived
+            while (self.samples.end - 2 * self.ctx) // self.frame_hop - self.num_frames >= self.hop_frames:
+                posterior = self._step(self.num_frames + self.hop_frames)
+                if posterior is not None:
+                    posteriors.append(posterior)
+        return posteriors
+
+    def _step(self, ready):
+        start = self.num_frames * self.frame_hop
+        seg = self.samples.read(start, ready * self.frame_hop + 2 * self.ctx)
+        x = torch.from_numpy(np.ascontiguousarray(seg)).view(1, 1, -1)
+        if self.cuda:
+            x = x.cuda()
+
+        with torch.no_grad():
+            self.out = self.model.frontend(x, out=self.out)
+            h = self.out[0, 0]  # (96L, hop_frames + 2 * ctx_frames)
+            h = h[:, self.ctx_frames: h.size(1) - self.ctx_frames].cpu().numpy()
+
+            if self.frames is None:
+                self.frames = RingBuffer(self.win_frames, shape=(h.shape[0],))
+            self.frames.write(h)
+            self.num_frames = ready
+
+            if self.num_frames < self.win_frames:
+                return self.posterior
+
+            win = self.frames.read(self.frames.end - self.win_frames, self.frames.end)
+            win = torch.from_numpy(np.ascontiguousarray(win)).view(1, 1, win.shape[0], -1)
+            if self.cuda:
+                win = win.cuda()
+            prob = F.softmax(self.model.backend(backend_input(self.model, win)), dim=1)[0].cpu().numpy()
+
+        if self.posterior is None:
+            self.posterior = prob
+        else:
+            self.posterior = self.smoothing * self.posterior + (1 - self.smoothing) * prob
+        return self.posterior
+
+
+def check_stream(model, wave, fs=44100, hop_size=8820):
+    """
+    compare the posteriors of a StreamingPredictor (without smoothing) with the softmax of
+    inference.window_scores over the same windows of wave.
+
+    :return: number of posteriors, max absolute difference of the probabilities.
+    """
+    predictor = StreamingPredictor(model, hop_size=hop_size, smoothing=0., fs=fs)
+    win_size = predictor.win_frames * predictor.frame_hop
+    streamed, windows = [], []
+    for k in range(0, len(wave), predictor.hop_size):
+        for posterior in predictor.feed(wave[k: k + predictor.hop_size]):
+            # the last window ends at the last frame of the stream
+            end = predictor.num_frames * predictor.frame_hop
+            streamed.append(posterior)
+            windows.append(wave[end - win_size: end])
+    scores, _ = window_scores(model, np.stack(windows), np.arange(len(windows)), win_size, win_size,
+                              len(windows), threshold=0.)
+    probs = F.softmax(scores, dim=1).numpy()
+    return len(streamed), float(np.abs(np.stack(streamed) - probs).max())
+
+
+class FileSource(object):
+    """
+    file-backed stand-in for a live audio source, yields fixed-size chunks.
+    .npy files are memory-mapped, anything else is decoded with librosa.
+    """
+    def __init__(self, path, fs=44100, chunk_size=1024, realtime=False):
+        if path.endswith('.npy'):
+            self.wave = np.load(path, mmap_mode='r')
+        else:
+            self.wave, _ = librosa.load(path, fs)
+        self.fs = fs
+        self.chunk_size = chunk_size
+        self.realtime = realtime
+
+    def __iter__(self):
+        start = time.time()
+        for k in range(0, len(self.wave), self.chunk_size):
+            if self.realtime:
+                # wait until the chunk would have been captured
+                delay = start + float(k + self.chunk_size) / self.fs - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield np.asarray(self.wave[k: k+self.chunk_size], dtype=np.float32)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='streaming latency and throughput benchmark')
+    parser.add_argument('--model', type=str, default=None, help='trained model path')
+    parser.add_argument('--source', type=str, default=None, help='audio or .npy file fed as a stream')
+    parser.add_argument('--check', type=str, default=None,
+                        help='comma separated networks, e.g. WaveMsNet,WaveMsNet_fixed_logmel: compare '
+                             'the posteriors of untrained models on random audio with window_scores and exit')
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--chunk_size', type=int, default=1024, help='samples per chunk of the source')
+    parser.add_argument('--hop', type=float, default=0.2, help='seconds between posteriors')
+    parser.add_argument('--smoothing', type=float, default=0.5)
+    parser.add_argument('--realtime', action='store_true', default=False,
+                        help='pace the source at the sample rate')
+    parser.add_argument('--dataset', type=str, default='ESC-50', help='ESC-10 or ESC-50, for label names')
+    parser.add_argument('--no-cuda', action='store_true', default=False)
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    if args.check:
+        torch.manual_seed(0)
+        wave = (0.1 * np.random.RandomState(0).randn(4 * args.fs)).astype(np.float32)
+        for name in args.check.split(','):
+            num, diff = check_stream(globals()[name](fs=args.fs).eval(), wave, args.fs, int(args.fs * args.hop))
+            # the streamed frames only differ at the zero padding of the window edges
+            print('{}: {} posteriors, max |stream - window| = {:.2e}'.format(name, num, diff))
+            assert diff < 1e-3, 'streamed posteriors differ from window_scores'
+        exit(0)
+    if args.model is None or args.source is None:
+        parser.error('--model and --source are required')
+
+    model = torch.load(args.model, map_location='cpu')
+    if args.cuda:
+        model.cuda()
+    predictor = StreamingPredictor(model, hop_size=int(args.fs * args.hop), smoothing=args.smoothing,
+                                   fs=args.fs, cuda=args.cuda)
+    source = FileSource(args.source, args.fs, args.chunk_size, args.realtime)
+
+    latency = []
+    num_samples = 0
+    start = time.time()
+    for chunk in source:
+        t = time.time()
+        posteriors = predictor.feed(chunk)
+        num_samples += len(chunk)
+        for posterior in posteriors:
+            latency.append(time.time() - t)
+            top = int(np.argmax(posterior))
+            print('{:8.2f}s  {:<20s} {:.3f}'.format(
+                float(num_samples) / args.fs, id_to_lb(top, args.dataset), posterior[top]))
+    elapse = time.time() - start
+
+    audio_time = float(num_samples) / args.fs
+    print('\nhops: {}  hop: {:.3f}s  chunk: {} samples'.format(
+        len(latency), float(predictor.hop_size) / args.fs, args.chunk_size))
+    if latency:
+        print('latency per hop: p50 {:.1f}ms  p99 {:.1f}ms  max {:.1f}ms'.format(
+            1000 * np.percentile(latency, 50), 1000 * np.percentile(latency, 99), 1000 * np.max(latency)))
+    print('throughput: {:.1f}s of audio in {:.1f}s ({:.1f}x real time)'.format(
+        audio_time, elapse, audio_time / elapse))
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+tag long recordings with a sliding window, in constant memory.
+
+usage:
+    python tag.py --model='../model/WaveMsNet_fold0_epoch160.pkl' --out_dir='../tags' recording1.wav recording2.flac
+    python tag.py --model='...' --list=recordings.txt --num_workers=4
+
+for each recording, <out_dir>/<name>.tsv has one line per window:
+    start(s)  end(s)  label_1  score_1 ... label_k  score_k
+
+"""
+import argparse
+import os
+import time
+import threading
+import multiprocessing
+from queue import Queue
+import numpy as np
+import soundfile
+import torch
+import torch.nn.functional as F
+from network import *
+from inference import *
+from util import *
+
+
+def read_blocks(path, fs, block_size, overlap, min_size=0):
+    """
+    decode a recording block by block, each block overlaps the previous one by `overlap` samples.
+
+    :return: yields 1-D float32 blocks at fs. Blocks are resampled one by one if the file has
+             another sample rate. A recording shorter than `min_size` is zero-padded to it.
+    """
+    sf = soundfile.SoundFile(path)
+    ratio = float(sf.samplerate) / fs
+    src_block = int(round(block_size * ratio))
+    src_overlap = int(round(overlap * ratio))
+    first = True
+
+    for block in sf.blocks(blocksize=src_block, overlap=src_overlap, dtype='float32', always_2d=True):
+        block = block.mean(axis=1)  # mono
+        if sf.samplerate != fs:
+            block = librosa.resample(block, orig_sr=sf.samplerate, target_sr=fs).astype(np.float32)
+            expected = int(round(len(block) / ratio)) if len(block) < src_block else block_size
+            block = block[:expected]
+        if first and len(block) < min_size:
+            block = np.r_[block, np.zeros(min_size - len(block), dtype=np.float32)]
+        first = False
+        yield block
+    sf.close()
+
+
+def prefetch(iterator, depth=2):
+    """
+    run iterator in a background thread, decoding overlaps with the forward passes.
+    """
+    queue = Queue(maxsize=depth)
+    end = object()
+    errors = []
+
+    def worker():
+        try:
+            for item in iterator:
+                queue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.put(end)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = queue.get()
+        if item is end:
+            break
+        yield item
+    if errors:
+        raise errors[0]
+
+
+def tag_file(model, path, out_path, fs=44100, win_size=None, hop=0.5, block_windows=32,
+             batch_size=32, top_k=3, threshold=0.005, dataset='ESC-50', cuda=False):
+    """
+    write the top-k labels of every window of a recording to out_path.
+
+    the recording is read in blocks of block_windows windows; the frontend runs once
+    per block and its output is cropped into windows (inference.frontend_crops), so
+    memory only depends on block_windows, not on the length of the recording.
+    :param win_size: default util.window_length(fs), 66150 at 44.1kHz
+    :param hop: seconds between windows, rounded to a multiple of model.hop samples.
+    :return: number of windows and seconds of audio tagged.
+    """
+    win_size = win_size or window_length(fs)
+    stride_frames = max(1, int(round(hop * fs / float(model.hop))))
+    stride = stride_frames * model.hop
+    block_size = win_size + (block_windows - 1) * stride
+    overlap = win_size - stride
+
+    num_wins = 0
+    with open(out_path, 'w') as out, torch.no_grad():
+        for block in prefetch(read_blocks(path, fs, block_size, overlap, min_size=win_size)):
+            if len(block) < win_size:
+                break
+            maxamp = window_maxamp(block, win_size, stride)
+
+            x = torch.from_numpy(block).view(1, 1, -1)
+            if cuda:
+                x = x.cuda()
+            crops = frontend_crops(model, x, win_size, stride_frames)[:len(maxamp)]
+
+            probs = []
+            for b in range(0, crops.size(0), batch_size):
+                probs.append(F.softmax(model.backend(backend_input(model, crops[b: b+batch_size])), dim=1).cpu())
+            probs = torch.cat(probs).numpy()
+            top = np.argsort(-probs, axis=1)[:, :top_k]
+
+            for j in range(len(probs)):
+                start = float((num_wins + j) * stride) / fs
+                line = '{:.2f}\t{:.2f}'.format(start, start + float(win_size) / fs)
+                if maxamp[j] < threshold:
+                    line += '\tsilence'
+                else:
+                    for k in top[j]:
+                        line += '\t{}\t{:.3f}'.format(id_to_lb(int(k), dataset), probs[j, k])
+                out.write(line + '\n')
+            num_wins += len(probs)
+
+    return num_wins, float((num_wins - 1) * stride + win_size) / fs if num_wins else 0.
+
+
+def init_worker(model_path, num_threads, cuda):
+    global worker_model, worker_cuda
+    torch.set_num_threads(num_threads)
+    worker_model = torch.load(model_path, map_location='cpu').eval()
+    worker_cuda = cuda
+    if cuda:
+        worker_model.cuda()
+
+
+def run_worker(job):
+    path, out_path, kwargs = job
+    start = time.time()
+    num_wins, duration = tag_file(worker_model, path, out_path, cuda=worker_cuda, **kwargs)
+    return path, num_wins, duration, time.time() - start
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='batch tagging of long recordings')
+    parser.add_argument('files', nargs='*', help='audio files to tag')
+    parser.add_argument('--list', type=str, help='text file with one audio path per line')
+    parser.add_argument('--model', type=str, required=True, help='trained model path')
+    parser.add_argument('--out_dir', type=str, default='../tags')
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--hop', type=float, default=0.5, help='seconds between windows')
+    parser.add_argument('--block_windows', type=int, default=32,
+                        help='windows decoded and evaluated per block, bounds the memory use')
+    parser.add_argument('--batch_size', type=int, default=32, help='windows per backend batch')
+    parser.add_argument('--top_k', type=int, default=3)
+    parser.add_argument('--dataset', type=str, default='ESC-50', help='ESC-10 or ESC-50, for label names')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='processes, files are sharded across them')
+    parser.add_argument('--no-cuda', action='store_true', default=False)
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    files = list(args.files)
+    if args.list:
+        with open(args.list, 'r') as f:
+            files += [line.strip() for line in f if line.strip()]
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    kwargs = {'fs': args.fs, 'hop': args.hop, 'block_windows': args.block_windows,
+              'batch_size': args.batch_size, 'top_k': args.top_k, 'dataset': args.dataset}
+    jobs = [(f, os.path.join(args.out_dir, os.path.splitext(os.path.basename(f))[0] + '.tsv'), kwargs)
+            for f in files]
+
+    # split the cores between worker processes
+    num_workers = max(1, min(args.num_workers, len(jobs)))
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+
+    start = time.time()
+    total = 0.
+    pool = None
+    if num_workers == 1:
+        init_worker(args.model, num_threads, args.cuda)
+        results = map(run_worker, jobs)
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=init_worker,
+                                    initargs=(args.model, num_threads, args.cuda))
+        results = pool.imap_unordered(run_worker, jobs)
+
+    for path, num_wins, duration, elapse in results:
+        total += duration
+        print('{}: {} windows, {:.1f}s of audio in {:.1f}s'.format(path, num_wins, duration, elapse))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapse = time.time() - start
+    print('\ntagged {} files, {:.1f}s of audio in {:.1f}s ({:.1f}x real time)'.format(
+        len(jobs), total, elapse, total / elapse))
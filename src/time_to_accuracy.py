@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+time to a target test accuracy of training configurations.
+
+usage:
+    python time_to_accuracy.py --fold=0 --targets=60,70,75 --val_interval=5 \
+        --config='base:' --config='bs64:--batch-size=64 --lr=0.02' \
+        --config='crops4:--crops_per_sample=4' --config='fs16k:--fs=16000' \
+        --config='logmel:--network=WaveMsNet_Logmel' \
+        --network=WaveMsNet --epochs=160 --lr=0.01 --momentum=0.9 --weight_decay=5e-4
+    python time_to_accuracy.py --out_dir=../log/tta --summarize
+
+each config is a name and the main.py options it changes; options not listed below
+are passed on to main.py for every config. The configs run one after the other, so
+their times are comparable, with main.py --val_interval and --curve: every test of a
+fold appends (epoch, train time, wall time, samples seen, TestACC) to
+<out_dir>/<name>.jsonl, and the log goes to <out_dir>/<name>.log. A fold stops once it
+reaches the highest target, unless --full.
+
+the time to a target is the training time (tests left out, so the cadence does not
+bias it; --clock=wall counts them) at the first test reaching it, averaged over the
+folds that reached it. Configs are printed cheapest first, and <out_dir>/summary.json
+and <out_dir>/curves.tsv (one row per test, to plot accuracy against time) are written.
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def parse_config(config):
+    """
+    :param config: 'name:--opt=value --opt2=value2'
+    :return: name, list of main.py options.
+    """
+    name, _, options = config.partition(':')
+    if not name:
+        raise ValueError('config {} has no name, expected name:options'.format(config))
+    return name, options.split()
+
+
+def run_config(name, options, folds, main_args, out_dir, val_interval, target_acc):
+    """
+    train every fold of a config with main.py, its curve goes to <out_dir>/<name>.jsonl.
+    :return: exit status of main.py for each fold.
+    """
+    curve_path = os.path.join(out_dir, name + '.jsonl')
+    log_path = os.path.join(out_dir, name + '.log')
+    if os.path.exists(curve_path):
+        os.remove(curve_path)
+
+    rets = []
+    with open(log_path, 'w') as log:
+        for fold_num in folds:
+            # options of the config come last and override the common ones
+            cmd = [sys.executable, '-u', 'main.py', '--fold=' + str(fold_num), '--val_interval=' + str(val_interval),
+                   '--curve=' + curve_path] + \
+                  (['--target_acc=' + str(target_acc)] if target_acc is not None else []) + main_args + options
+            print('{} fold {}: {}'.format(name, fold_num, ' '.join(cmd[2:])))
+            start = time.time()
+            log.flush()
+            ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+            print('{} fold {}: exit {}, {:.1f}s'.format(name, fold_num, ret, time.time() - start))
+            rets.append(ret)
+    return rets
+
+
+def load_curve(path):
+    """
+    :return: {fold: [record of each test, in epoch order]}
+    """
+    curves = OrderedDict()
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                curves.setdefault(record['fold'], []).append(record)
+    return curves
+
+
+def time_to_target(curve, target, clock='train'):
+    """
+    :return: (seconds, epoch, samples) at the first test of the curve reaching target, None if none did.
+    """
+    for record in curve:
+        if record['test_acc'] >= target:
+            return record[clock + '_s'], record['epoch'], record['samples']
+    return None
+
+
+def summarize(name, curves, targets, clock='train'):
+    summary = OrderedDict([('config', name), ('folds', len(curves)),
+                           ('best_acc', float(np.mean([max(r['test_acc'] for r in c) for c in curves.values()]))),
+                           ('total_s', float(np.mean([c[-1][clock + '_s'] for c in curves.values()])))])
+    summary['targets'] = OrderedDict()
+    for target in targets:
+        reached = [t for t in (time_to_target(c, target, clock) for c in curves.values()) if t is not None]
+        summary['targets'][str(target)] = OrderedDict([
+            ('reached', len(reached)),
+            ('seconds', float(np.mean([t[0] for t in reached])) if reached else None),
+            ('epochs', float(np.mean([t[1] for t in reached])) if reached else None),
+            ('samples', float(np.mean([t[2] for t in reached])) if reached else None)])
+    return summary
+
+
+def cost(summary, target):
+    # configs reaching the target in every fold first, then by time
+    t = summary['targets'][str(target)]
+    return (t['reached'] < summary['folds'], t['seconds'] if t['seconds'] is not None else float('inf'))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='time to target accuracy of training configurations')
+    parser.add_argument('--config', type=str, action='append', default=[],
+                        help='name:main.py options, repeat for each config')
+    parser.add_argument('--targets', type=str, default='60,70,75', help='comma separated TestACC percentages')
+    parser.add_argument('--folds', type=str, default='0', help='comma separated fold numbers')
+    parser.add_argument('--val_interval', type=int, default=5, help='epochs between tests')
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='run all the epochs instead of stopping at the highest target')
+    parser.add_argument('--clock', type=str, default='train', help='train (tests left out) or wall')
+    parser.add_argument('--out_dir', type=str, default='../log/tta')
+    parser.add_argument('--summarize', action='store_true', default=False,
+                        help='only summarize the curves already in --out_dir')
+    args, main_args = parser.parse_known_args()
+
+    if args.clock not in ('train', 'wall'):
+        raise ValueError('unknown clock {}, expected train or wall'.format(args.clock))
+    targets = [float(t) for t in args.targets.split(',')]
+    folds = [int(f) for f in args.folds.split(',')]
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    if args.summarize:
+        names = sorted(f[:-len('.jsonl')] for f in os.listdir(args.out_dir) if f.endswith('.jsonl'))
+    else:
+        configs = [parse_config(c) for c in args.config] or [('base', [])]
+        names = [name for name, _ in configs]
+        for name, options in configs:
+            run_config(name, options, folds, main_args, args.out_dir, args.val_interval,
+                       None if args.full else max(targets))
+
+    summaries = []
+    with open(os.path.join(args.out_dir, 'curves.tsv'), 'w') as tsv:
+        tsv.write('config\tfold\tepoch\ttrain_s\twall_s\tsamples\tlr\ttest_acc\n')
+        for name in names:
+            path = os.path.join(args.out_dir, name + '.jsonl')
+            curves = load_curve(path) if os.path.exists(path) else {}
+            if not curves:
+                print('{}: no test was recorded, see {}'.format(name, os.path.join(args.out_dir, name + '.log')))
+                continue
+            for fold_num, curve in curves.items():
+                for r in curve:
+                    tsv.write('{}\t{}\t{}\t{:.1f}\t{:.1f}\t{}\t{:.4g}\t{:.2f}\n'.format(
+                        name, fold_num, r['epoch'], r['train_s'], r['wall_s'], r['samples'], r['lr'], r['test_acc']))
+            summaries.append(summarize(name, curves, targets, args.clock))
+
+    summaries.sort(key=lambda s: cost(s, max(targets)))
+    with open(os.path.join(args.out_dir, 'summary.json'), 'w') as f:
+        json.dump({'clock': args.clock, 'targets': targets, 'configs': summaries}, f, indent=1)
+
+    print('\ntime to TestACC ({} time, mean over the folds reaching it)'.format(args.clock))
+    print('{:<16s} {:>6s} {:>9s} {:>9s}'.format('config', 'folds', 'best', 'total(s)') +
+          ''.join(' {:>16s}'.format('{:g}%'.format(t)) for t in targets))
+    for s in summaries:
+        cells = []
+        for target in targets:
+            t = s['targets'][str(target)]
+            if t['seconds'] is None:
+                cells.append(' {:>16s}'.format('-'))
+            else:
+                cells.append(' {:>16s}'.format('{:.0f}s ep{:.0f}{}'.format(
+                    t['seconds'], t['epochs'], '' if t['reached'] == s['folds'] else ' ({})'.format(t['reached']))))
+        print('{:<16s} {:6d} {:8.2f}% {:9.0f}'.format(s['config'], s['folds'], s['best_acc'], s['total_s']) +
+              ''.join(cells))
+    print('summary saved as: ' + os.path.join(args.out_dir, 'summary.json'))